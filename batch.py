@@ -1,17 +1,24 @@
 
 import argparse
+import multiprocessing as mp
+import os
 import sys
 from pathlib import Path
 from shared import add_video_parser_args, add_visualizer_parser_args, get_trim, VIDEO_EXT
-from video_processing import process_video_frames
+from video_processing import process_video_frames, get_frame_stride, save_metrics
+from src.metrics import Metrics
 from visualize_results import encode_debug_figures
 
 from batch_processing import Batch
 from unified_path import append_stem
 from main import get_model
-from moviepy.editor import VideoFileClip
 import logging
 
+# Body of the current process with -mp: inherited from the parent by forked pool workers
+# (weights shared copy-on-write) or loaded once by each worker otherwise.
+WORKER_MODEL = None
+WORKER_PID = None
+
 def parse_command_line(batch: Batch) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Batch video processing - OpenPose',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -20,12 +27,29 @@ def parse_command_line(batch: Batch) -> argparse.Namespace:
     parser.add_argument("-vsuf", "--visualization-suffix", default="gif", choices=["gif"] + VIDEO_EXT)
     parser.add_argument("-mp", "--multi-processing", action="store_true", help="Enable multiprocessing - Warning with GPU - use -j2")    
     parser.add_argument("-skip", "--skip-existing", action="store_true", help="skip existing processed folders")
-    return batch.parse_args(parser)
+    args = batch.parse_args(parser)
+    assert not (args.visualize and args.visualization == "none"), "-v needs debug images, use --visualization fast"
+    return args
+
+
+def get_worker_model(args: argparse.Namespace):
+    """Model of the current worker process, loaded at most once per process.
+
+    The CPU threads are split between the workers so that they do not oversubscribe the cores.
+    """
+    global WORKER_MODEL, WORKER_PID
+    import torch
+    if WORKER_PID != os.getpid():
+        WORKER_PID = os.getpid()
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // max(1, args.num_processes)))
+    if WORKER_MODEL is None:
+        WORKER_MODEL = get_model(scale_search=args.scales, num_stages=args.stages, interpolation="area")
+    return WORKER_MODEL
 
 
 def parallel_process(input: Path, output: Path, args: argparse.Namespace, model=None):
     if model is None:
-        model = get_model() # Load model for each thread , be careful!
+        model = get_worker_model(args) # Model of the pool worker, loaded once
     print(input, output.parent)
     trim = get_trim(args)
     if output.exists() and args.skip_existing:
@@ -33,10 +57,21 @@ def parallel_process(input: Path, output: Path, args: argparse.Namespace, model=
     else:
         logging.warning(f"Reprocessing found results - use --skip-existing to skip processing  {output}")
         output.mkdir(parents=True, exist_ok=True)
-        process_video_frames(input, output, trim=trim)
+        metrics = Metrics() if args.metrics else None
+        process_video_frames(input, output, trim=trim, model=model, batch_size=args.batch_size, pipelined=args.pipelined,
+                             frame_stride=args.frame_stride, target_fps=args.target_fps,
+                             tracking=args.tracking, refresh_interval=args.refresh_interval,
+                             visualization=args.visualization, pose_format=args.pose_format, metrics=metrics,
+                             target_height=args.target_height)
+        if metrics is not None:
+            save_metrics(metrics, output, args.metrics)
     
     if not args.framerate:
-        fps = VideoFileClip(str(input)).fps
+        from moviepy.video.io.VideoFileClip import VideoFileClip
+        with VideoFileClip(str(input)) as video:
+            fps = video.fps
+        # one visualization per processed frame
+        fps = max(1, int(round(fps / get_frame_stride(fps, args.frame_stride, args.target_fps))))
         print(f"Auto framerate deduced: {fps}")
     else:
         fps = args.framerate
@@ -48,6 +83,7 @@ def parallel_process(input: Path, output: Path, args: argparse.Namespace, model=
         )
 
 def main(argv):
+    global WORKER_MODEL
     # Instantiate batch
     batch = Batch(argv)
     batch.set_io_description(input_help='input video files', output_help='output directory')
@@ -58,11 +94,17 @@ def main(argv):
     multiprocessing = args.multi_processing
     # Disable mp - Highly recommended!
     if multiprocessing:
+        import torch
         model = None
+        if mp.get_start_method() == "fork" and not torch.cuda.is_available():
+            # Load the model before the pool forks: workers share its weights copy-on-write.
+            # Single threaded until then, forking after OpenMP threads are started may hang the workers.
+            torch.set_num_threads(1)
+            WORKER_MODEL = get_model(scale_search=args.scales, num_stages=args.stages, interpolation="area")
     else:
         # Disable multiprocessing -> single 
         batch.set_multiprocessing_enabled(False)
-        model = get_model() # Create the model only one
+        model = get_model(scale_search=args.scales, num_stages=args.stages, interpolation="area") # Create the model only one
     batch.run(parallel_process, model)
 
 
@@ -0,0 +1,201 @@
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+import torch
+
+from src import util
+from src.body import (LIMB_SEQ, MAP_IDX, SCALE_PRESETS, Body, assemble_people, connect_limbs, find_peaks,
+                      find_peaks_network, resize_to_image)
+from src.model import bodypose_model
+
+STRIDE = 8
+BOXSIZE = 368
+# joints of a standing person in person units (x right, y down), OpenPose part order
+POSE_TEMPLATE = np.array([[0, -3], [0, -2], [-1, -2], [-1.3, -0.8], [-1.4, 0.2], [1, -2], [1.3, -0.8], [1.4, 0.2],
+                          [-0.6, 0.3], [-0.6, 1.8], [-0.6, 3.2], [0.6, 0.3], [0.6, 1.8], [0.6, 3.2],
+                          [-0.3, -3.2], [0.3, -3.2], [-0.6, -3.0], [0.6, -3.0]])
+
+
+def synthetic_maps(height, width, num_persons, rng, sigma=6.):
+    """Heatmaps [H, W, 19] and part affinity fields [H, W, 38] of randomly placed people at image resolution."""
+    heatmap = np.zeros((height, width, 19), dtype=np.float32)
+    paf = np.zeros((height, width, 38), dtype=np.float32)
+    radius = int(3 * sigma)
+    gaussian = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma ** 2)).astype(np.float32)
+    gaussian = np.outer(gaussian, gaussian)
+    for _ in range(num_persons):
+        unit = rng.uniform(height / 40, height / 20)
+        center = rng.uniform([3 * unit, 4 * unit], [width - 3 * unit, height - 4 * unit])
+        joints = center + POSE_TEMPLATE * unit + rng.randn(18, 2) * unit * 0.1
+        for part, (x, y) in enumerate(np.round(joints).astype(int)):
+            y0, y1, x0, x1 = max(0, y - radius), min(height, y + radius + 1), max(0, x - radius), min(width, x + radius + 1)
+            if y0 >= y1 or x0 >= x1:
+                continue
+            patch = gaussian[y0 - y + radius:y1 - y + radius, x0 - x + radius:x1 - x + radius]
+            heatmap[y0:y1, x0:x1, part] = np.maximum(heatmap[y0:y1, x0:x1, part], patch)
+        for k, (part_a, part_b) in enumerate(LIMB_SEQ):
+            a, b = joints[part_a - 1], joints[part_b - 1]
+            direction = (b - a) / max(np.linalg.norm(b - a), 1e-3)
+            for channel, value in zip(MAP_IDX[k], direction):
+                field = np.ascontiguousarray(paf[:, :, channel - 19])
+                cv.line(field, tuple(np.round(a).astype(int)), tuple(np.round(b).astype(int)), float(value),
+                        thickness=max(2, int(unit / 2)))
+                paf[:, :, channel - 19] = field
+    heatmap[:, :, 18] = 1 - heatmap[:, :, :18].max(axis=2)
+    return heatmap, paf
+
+
+def network_maps(maps, scale, pad, net_shape):
+    """Image resolution maps as the network outputs them for a resized and padded pyramid level."""
+    maps = cv.resize(maps, (0, 0), fx=scale, fy=scale, interpolation=cv.INTER_LINEAR)
+    maps = np.pad(maps, ((0, pad[2]), (0, pad[3]), (0, 0)))
+    return cv.resize(maps, (net_shape[1], net_shape[0]), interpolation=cv.INTER_LINEAR)
+
+
+def time_stage(function, repeats, warmup=1):
+    """Run function warmup + repeats times, returns the timings of the repeats in milliseconds."""
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append(1000 * (time.perf_counter() - start))
+    return timings
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_resolution(body, height, width, persons, repeats, rng):
+    """Time each stage of the Body pipeline on synthetic data at one resolution.
+
+    Returns:
+        list: one result dictionary per stage (and person count for the post-processing stages).
+    """
+    image = rng.randint(0, 256, (height, width, 3), dtype=np.uint8)
+    multiplier = [x * BOXSIZE / height for x in body.scale_search]
+    # resized and padded size of each pyramid level, as in Body._forward
+    sizes = [(round(height * scale), round(width * scale)) for scale in multiplier]
+    padded_sizes = [(-(-h // STRIDE) * STRIDE, -(-w // STRIDE) * STRIDE) for h, w in sizes]
+    results = []
+
+    def record(stage, timings, num_persons=None):
+        results.append({"stage": stage, "resolution": f"{width}x{height}", "persons": num_persons,
+                        "median_ms": float(np.median(timings)), "mean_ms": float(np.mean(timings)),
+                        "min_ms": float(np.min(timings)), "repeats": len(timings)})
+
+    def preprocess(level):
+        # single resize of the image into the reused network input of Body
+        return body._preprocess([image], [multiplier[level]], [sizes[level]], padded_sizes[level])
+
+    record("preprocess", time_stage(lambda: [preprocess(level) for level in range(len(multiplier))], repeats))
+    # copies, levels of the same padded size share an input buffer
+    inputs = [preprocess(level).copy() for level in range(len(multiplier))]
+    record("forward", time_stage(lambda: [body.backend(im) for im in inputs], repeats))
+
+    # network output of the first pyramid level, image resolution maps for the next stages
+    padded_shape = padded_sizes[0] + (3,)
+    pad = [0, 0, padded_sizes[0][0] - sizes[0][0], padded_sizes[0][1] - sizes[0][1]]
+    net_shape = (padded_shape[0] // STRIDE, padded_shape[1] // STRIDE)
+    for num_persons in persons:
+        heatmap_avg, paf_avg = synthetic_maps(height, width, num_persons, rng)
+        heatmap_net = network_maps(heatmap_avg, multiplier[0], pad, net_shape)
+        paf_net = network_maps(paf_avg, multiplier[0], pad, net_shape)
+
+        def upsample():
+            for net_map in (heatmap_net, paf_net):
+                resize_to_image(net_map, padded_shape, pad, image.shape, STRIDE)
+
+        record("upsample", time_stage(upsample, repeats), num_persons)
+        record("peaks", time_stage(lambda: find_peaks(heatmap_avg), repeats), num_persons)
+        # network maps covering the unpadded image, as average_network_outputs returns them
+        heatmap_crop = heatmap_net[:sizes[0][0] // STRIDE, :sizes[0][1] // STRIDE]
+        scale_xy = (multiplier[0], multiplier[0])
+        record("peaks_network", time_stage(lambda: find_peaks_network(heatmap_crop, image.shape, scale_xy), repeats),
+               num_persons)
+        all_peaks = find_peaks(heatmap_avg)
+        record("limbs", time_stage(lambda: connect_limbs(all_peaks, paf_avg, height), repeats), num_persons)
+        connection_all, special_k = connect_limbs(all_peaks, paf_avg, height)
+        candidate = np.array([item for sublist in all_peaks for item in sublist])
+        record("assembly", time_stage(lambda: assemble_people(connection_all, special_k, candidate, LIMB_SEQ), repeats),
+               num_persons)
+        subset = assemble_people(connection_all, special_k, candidate, LIMB_SEQ)
+        record("draw", time_stage(lambda: util.draw_bodypose(image.copy(), candidate, subset), repeats), num_persons)
+        print(f"{width}x{height} | {num_persons:3d} persons | {len(subset):3d} found | {len(candidate):4d} peaks")
+    return results
+
+
+def compare(results, baseline):
+    """Print the speedup of each benchmark entry against a previous result file."""
+    reference = {(r["stage"], r["resolution"], r["persons"]): r for r in baseline["results"]}
+    print(f"Compared to {baseline['meta'].get('commit')} ({baseline['meta'].get('date')})")
+    for result in results["results"]:
+        key = (result["stage"], result["resolution"], result["persons"])
+        if key in reference:
+            speedup = reference[key]["median_ms"] / max(result["median_ms"], 1e-9)
+            persons = "" if result["persons"] is None else f"{result['persons']} persons"
+            print(f"{result['stage']:14s} {result['resolution']:>10s} {persons:>11s} | "
+                  f"{reference[key]['median_ms']:9.2f} ms -> {result['median_ms']:9.2f} ms | x{speedup:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage of the Body pipeline on synthetic images and heatmaps, "
+        "with random weights (no model download needed)")
+    parser.add_argument("-r", "--resolutions", nargs="+", default=["320x240", "640x480", "1280x720", "1920x1080"],
+                        help="Image resolutions WIDTHxHEIGHT")
+    parser.add_argument("-p", "--persons", nargs="+", type=int, default=[1, 4, 16], help="Number of synthetic people")
+    parser.add_argument("--scales", default="fast", choices=list(SCALE_PRESETS.keys()), help="Multi-scale search preset")
+    parser.add_argument("-n", "--repeats", type=int, default=5, help="Timed runs of each stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, default=None, help="Save the results to a json file")
+    parser.add_argument("--compare", type=str, default=None, help="Previous json results to compare with")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    torch.manual_seed(args.seed)
+    results = []
+    # the weights may be memory-mapped, keep them on disk for as long as the model is used
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        weights_path = Path(tmp_dir) / "random_body_pose_model.pt"
+        torch.save(bodypose_model().state_dict(), weights_path)
+        body = Body(weights_path, scale_search=args.scales)
+        for resolution in args.resolutions:
+            width, height = (int(size) for size in resolution.lower().split("x"))
+            results.extend(benchmark_resolution(body, height, width, args.persons, args.repeats, rng))
+        device_type = body.backend.device_type
+        del body
+    results = {
+        "meta": {"commit": git_commit(), "date": datetime.now().isoformat(timespec="seconds"),
+                 "scales": args.scales, "device": device_type, "torch_threads": torch.get_num_threads(),
+                 "torch": torch.__version__, "numpy": np.__version__, "opencv": cv.__version__,
+                 "python": platform.python_version(), "machine": platform.machine()},
+        "results": results,
+    }
+    for result in results["results"]:
+        persons = "" if result["persons"] is None else f"{result['persons']} persons"
+        print(f"{result['stage']:14s} {result['resolution']:>10s} {persons:>11s} | {result['median_ms']:9.2f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+# command line entry points, imported as modules
+ENTRY_POINTS = ["main", "video_processing", "batch", "visualize_results", "run_imagefolder", "server"]
+# dependencies only the code paths that need them shall import
+HEAVY_MODULES = ["torch", "torchvision", "matplotlib", "scipy", "moviepy.editor"]
+
+
+def import_profile(module: str):
+    """Import a module in a fresh interpreter with -X importtime.
+
+    Returns:
+        Tuple[float, List[str]]: cumulative import time in seconds and the imported modules.
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             cwd=Path(__file__).parent, capture_output=True, text=True)
+    assert process.returncode == 0, f"import {module} failed\n{process.stderr}"
+    total, modules = 0., []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        modules.append(name.strip())
+        if name.strip() == module:
+            total = int(cumulative) * 1e-6
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the import-time budget of the entry points, exit with an error when exceeded")
+    parser.add_argument("--budget", type=float, default=0.5, help="Maximal import time of an entry point, in seconds")
+    args = parser.parse_args()
+    failures = []
+    for module in ENTRY_POINTS:
+        total, modules = import_profile(module)
+        heavy = [name for name in HEAVY_MODULES if name in modules]
+        print(f"{module:20s} {total*1000:7.1f} ms {'imports ' + ', '.join(heavy) if heavy else ''}")
+        if total > args.budget:
+            failures.append(f"{module} takes {total:.2f} s to import (budget {args.budget:.2f} s)")
+        if heavy:
+            failures.append(f"{module} imports {', '.join(heavy)} at start-up")
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
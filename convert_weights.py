@@ -0,0 +1,22 @@
+import argparse
+
+from main import BODY_ESTIMATION_MODEL
+from src.backends import convert_weights, converted_weights_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the body pose weights once to a memory-mappable file loaded faster by Body")
+    parser.add_argument("-m", "--model", default=str(BODY_ESTIMATION_MODEL), type=str, help="PyTorch weights")
+    parser.add_argument("-o", "--output", default=None, type=str,
+                        help="Converted weights path, defaults to the weights path with a .converted.pt suffix "
+                        "which Body loads instead of the original weights")
+    args = parser.parse_args()
+    output_path = convert_weights(args.model, args.output)
+    print(f"Converted weights saved to {output_path}")
+    if args.output is not None and output_path != converted_weights_path(args.model):
+        print(f"Load them with Body({output_path})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import json
+
+import cv2 as cv
+import numpy as np
+from evaluation import keypoint_drift, run_body
+from main import BODY_ESTIMATION_MODEL, get_model
+from shared import get_image_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the int8 body pose model to the fp32 one: keypoint drift and speed")
+    parser.add_argument("-i", "--input", required=True, type=str, help="Folder of evaluation images (jpg, png)")
+    parser.add_argument("-q", "--quantized", default=str(BODY_ESTIMATION_MODEL.with_name("body_pose_model_int8.pt")),
+                        type=str, help="Quantized model exported by quantize_model.py")
+    parser.add_argument("-m", "--model", default=str(BODY_ESTIMATION_MODEL), type=str, help="fp32 weights")
+    parser.add_argument("-n", "--max-images", type=int, default=50, help="Maximum number of evaluation images")
+    parser.add_argument("--scales", default="fast", choices=["fast", "balanced", "accurate"],
+                        help="Multi-scale search preset")
+    parser.add_argument("--json", type=str, default=None, help="Optionally save the report to a json file")
+    args = parser.parse_args()
+
+    image_paths = get_image_paths(args.input)[:args.max_images]
+    assert len(image_paths) > 0, f"no image found in {args.input}"
+    images = [cv.imread(image_path) for image_path in image_paths] # B,G,R order
+
+    joints_fp32, time_fp32 = run_body(get_model(args.model, scale_search=args.scales), images)
+    joints_int8, time_int8 = run_body(get_model(args.quantized, scale_search=args.scales), images)
+    heights = np.array([image.shape[0] for image in images], dtype=float)
+
+    report = {"images": len(images)}
+    report.update(keypoint_drift(joints_fp32, joints_int8, heights))
+    report.update({
+        "time_fp32_ms": float(1000 * np.mean(time_fp32)),
+        "time_int8_ms": float(1000 * np.mean(time_int8)),
+        "speedup": float(np.mean(time_fp32) / np.mean(time_int8)),
+    })
+    for key, value in report.items():
+        print(f"{key:>32}: {value}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import argparse
+import json
+
+import cv2 as cv
+import numpy as np
+from evaluation import keypoint_drift, run_body
+from main import BODY_ESTIMATION_MODEL, get_model
+from shared import get_image_paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Accuracy and speed of the body pose model for each number of CPM stages, "
+        "compared to the full 6 stages model")
+    parser.add_argument("-i", "--input", required=True, type=str, help="Folder of evaluation images (jpg, png)")
+    parser.add_argument("-m", "--model", default=str(BODY_ESTIMATION_MODEL), type=str, help="Model weights")
+    parser.add_argument("-n", "--max-images", type=int, default=50, help="Maximum number of evaluation images")
+    parser.add_argument("-s", "--stages", nargs="+", type=int, default=[2, 3, 4, 5, 6], help="Stage counts to evaluate")
+    parser.add_argument("--scales", default="fast", choices=["fast", "balanced", "accurate"],
+                        help="Multi-scale search preset")
+    parser.add_argument("--json", type=str, default=None, help="Optionally save the report to a json file")
+    args = parser.parse_args()
+
+    image_paths = get_image_paths(args.input)[:args.max_images]
+    assert len(image_paths) > 0, f"no image found in {args.input}"
+    images = [cv.imread(image_path) for image_path in image_paths] # B,G,R order
+    heights = np.array([image.shape[0] for image in images], dtype=float)
+
+    joints_reference, time_reference = run_body(get_model(args.model, scale_search=args.scales), images)
+    report = []
+    for num_stages in sorted(args.stages):
+        joints, timings = run_body(get_model(args.model, scale_search=args.scales, num_stages=num_stages), images)
+        result = {"num_stages": num_stages, "time_ms": float(1000 * np.mean(timings)),
+                  "speedup": float(np.mean(time_reference) / np.mean(timings))}
+        result.update(keypoint_drift(joints_reference, joints, heights))
+        report.append(result)
+        print(f"{num_stages} stages | {result['time_ms']:8.1f} ms | x{result['speedup']:.2f} | "
+              f"drift {result['drift_px_median']} px (median) | agreement {result['detection_agreement']:.3f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from main import select_person_joints
+
+
+def run_body(body_estimation, images: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the [L, 18, 3] joints of the most confident person and the inference time of each image."""
+    joints_2d, timings = np.zeros((len(images), 18, 3)), []
+    body_estimation(images[0]) # warm up
+    for img_id, image in enumerate(images):
+        start = time.perf_counter()
+        candidate, subset, all_peaks = body_estimation(image)
+        timings.append(time.perf_counter() - start)
+        joints_2d[img_id] = select_person_joints(subset, all_peaks)
+    return joints_2d, np.array(timings)
+
+
+def keypoint_drift(joints_reference: np.ndarray, joints: np.ndarray, heights: np.ndarray) -> Dict[str, float]:
+    """Distance between the [L, 18, 3] joints found by two models, undetected joints are zeros."""
+    found_reference = joints_reference[..., 2] > 0
+    found = joints[..., 2] > 0
+    both = np.logical_and(found_reference, found)
+    drift = np.linalg.norm(joints_reference[..., :2] - joints[..., :2], axis=-1)[both]
+    relative_drift = drift / np.broadcast_to(heights[:, None], both.shape)[both]
+    return {
+        "joints_reference": int(found_reference.sum()),
+        "joints": int(found.sum()),
+        "detection_agreement": float(np.mean(found_reference == found)),
+        "drift_px_mean": float(np.mean(drift)) if len(drift) else None,
+        "drift_px_median": float(np.median(drift)) if len(drift) else None,
+        "drift_px_p95": float(np.percentile(drift, 95)) if len(drift) else None,
+        "drift_relative_to_height_mean": float(np.mean(relative_drift)) if len(drift) else None,
+    }
@@ -0,0 +1,20 @@
+import argparse
+
+from main import BODY_ESTIMATION_MODEL
+from src.backends import export_onnx
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the body pose model to ONNX (dynamic batch size, height and width)")
+    parser.add_argument("-m", "--model", default=str(BODY_ESTIMATION_MODEL), type=str, help="PyTorch weights")
+    parser.add_argument("-o", "--output", default=str(BODY_ESTIMATION_MODEL.with_suffix(".onnx")), type=str,
+                        help="ONNX model path, load it with Body(path)")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version")
+    args = parser.parse_args()
+    output_path = export_onnx(args.model, args.output, opset_version=args.opset)
+    print(f"ONNX model saved to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,178 @@
 import cv2 as cv
 import numpy as np
-import matplotlib.pyplot as plt
 import pickle as pk
 from glob import glob
 from os import makedirs
 from os.path import join, exists, basename
 import argparse
 import copy
+import queue
+import threading
 
-from src import model
 from src import util
-from src.body import Body
+from src.tracking import PoseTracker
+from src.pose_store import PoseStore
+from src.metrics import Metrics, NO_METRICS
 from pathlib import Path
 from typing import List, Union, Optional
 
+VISUALIZATIONS = ["fast", "figure", "none"]
+SCALES = ["fast", "balanced", "accurate"] # src.body.SCALE_PRESETS, not imported to keep torch out of start-up
 BODY_ESTIMATION_MODEL = Path(__file__).parent / 'model'/'body_pose_model.pth'
-assert BODY_ESTIMATION_MODEL.exists(), "please download torch models at " \
-"https://drive.google.com/drive/folders/1JsvI4M4ZTg98fmnCZLFM-3TeovnCRElG"
 
 
 
-def get_model(body_estimation=BODY_ESTIMATION_MODEL):
+def get_model(body_estimation=BODY_ESTIMATION_MODEL, **body_options):
+    """Load the body pose model, body_options are forwarded to Body (e.g. scale_search="accurate")."""
+    from src.body import Body # torch is only imported when a model is needed
     if isinstance(body_estimation, str) or isinstance(body_estimation, Path):
-        body_estimation = Body(BODY_ESTIMATION_MODEL)
+        assert Path(body_estimation).exists(), "please download torch models at " \
+        "https://drive.google.com/drive/folders/1JsvI4M4ZTg98fmnCZLFM-3TeovnCRElG"
+        body_estimation = Body(body_estimation, **body_options)
     else:
-        assert isinstance(body_estimation, Body), f"Wrong model type {type(body_estimation)}"
+        assert isinstance(body_estimation, (Body, PoseTracker)), f"Wrong model type {type(body_estimation)}"
     return body_estimation
 
+def select_person_joints(subset: np.ndarray, all_peaks: list) -> np.ndarray:
+    """Keep the joints of the most confident person.
+
+    Joints missing for that person are filled with the most confident peak of the same part.
+
+    Args:
+        subset (np.ndarray): [P, 20] people found by Body.
+        all_peaks (list): peaks (x, y, score, id) of each of the 18 parts.
+
+    Returns:
+        np.ndarray: array [18, 3] of (x, y, score), zeros for undetected joints.
+    """
+    joints_2d = np.zeros((18, 3))
+    # ------------------------------------------------------------
+    # Keep the most confident subset
+    # ------------------------------------------------------------
+
+    # Initialize the person with no joint and zero confidence
+    person = -1*np.ones((20)) # no peaks
+    person[-1] = 0. # no detected joints
+    person[-2] = 0. # zero score for that person
+    c_max = 0.
+    if len(subset)>0:
+        for i in range(len(subset)):
+            if subset[i][-2]>c_max:
+                c_max = subset[i][-2]
+                person = subset[i]
+
+    # Assign the most confident joint peak to missing joints in person
+    for i in range(18):
+        if person[i]== -1 and len(all_peaks[i])>0:
+            # seach the peak with highest score
+            joint_peaks = all_peaks[i]
+            max_score = 0.
+            pid = -1
+            for k in range(len(joint_peaks)):
+                if joint_peaks[k][2]>max_score:
+                    max_score = joint_peaks[k][2]
+                    pid = joint_peaks[k][3]
+            person[i] = pid
+
+    for i in range(18):
+        pid = person[i].astype(int)
+        if pid >= 0:
+            for j in range(len(all_peaks[i])):
+                if all_peaks[i][j][3] == pid:
+                    joint_position = np.array(all_peaks[i][j][0:3]) # 1d array
+                    break
+
+            joints_2d[i] = joint_position
+    return joints_2d
+
+def save_pose_visualization(oriImg: np.ndarray, candidate: np.ndarray, subset: np.ndarray, vis_path: Path) -> None:
+    """Draw the estimated joints on a copy of the input image and save the figure to vis_path.
+
+    Rendered with the Agg canvas, not pyplot, so it can run on a writer thread.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    canvas = copy.deepcopy(oriImg)
+    canvas = util.draw_bodypose(canvas, candidate, subset)
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    # ax.imshow(canvas[:, :, [2, 1, 0]])
+    ax.imshow(canvas)
+    ax.axis('off')
+    figure.savefig(vis_path)
+
+def save_pose_image(oriImg: np.ndarray, candidate: np.ndarray, subset: np.ndarray, vis_path: Path) -> None:
+    """Draw the estimated joints on a copy of the input image and save it at native resolution.
+
+    Same colors as save_pose_visualization, the canvas is saved as an RGB image like plt.imshow shows it.
+    """
+    canvas = util.draw_bodypose(oriImg.copy(), candidate, subset)
+    cv.imwrite(str(vis_path), canvas[:, :, ::-1])
+
+class VisualizationWriter(object):
+    """Draw and save pose images with save_pose_image on a background thread.
+
+    The bounded queue blocks the producer when drawing falls behind. Errors raised by the
+    writer thread are raised again by close(). The time spent per image is recorded as the "draw" stage of metrics.
+    """
+    def __init__(self, queue_size: int=16, metrics: Optional[Metrics]=None):
+        self.queue = queue.Queue(queue_size)
+        self.metrics = NO_METRICS if metrics is None else metrics
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.errors:
+                continue # keep draining to never block the producer
+            try:
+                with self.metrics.timer("draw"):
+                    save_pose_image(*item)
+            except Exception as e:
+                self.errors.append(e)
+
+    def put(self, oriImg: np.ndarray, candidate: np.ndarray, subset: np.ndarray, vis_path: Path) -> None:
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((oriImg, candidate, subset, vis_path))
+
+    def close(self) -> None:
+        """Wait for the pending images to be written."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def save_joints(joints_2d: np.ndarray, save_path: Path) -> None:
+    """Save a [L, 18, 3] joints array as a pose dictionary."""
+    data_dict = {
+        "joint_2d_positions": joints_2d,
+        # "image_names": [basename(image_paths[i]) for i in range(num_images)]
+    }
+    with open(save_path, 'wb') as f:
+        pk.dump(data_dict, f)
+
 def main(
         image_list: List[Union[Path, str, np.ndarray]],
-        vis_dir: Path, save_path: Optional[Path]=None,
+        vis_dir: Path, save_path: Optional[Union[Path, PoseStore]]=None,
         image_names: Optional[str]= None,
-        body_estimation: Union[Path, Body]=BODY_ESTIMATION_MODEL
+        body_estimation: Union[Path, "Body"]=BODY_ESTIMATION_MODEL,
+        batch_size: int=1,
+        visualization: Union[str, VisualizationWriter]="fast",
+        metrics: Optional[Metrics]=None,
+        target_height: Optional[int]=None
     ) -> np.ndarray:
     """Run Openpose on a set of images.
 
@@ -40,14 +181,20 @@ def main(
         a list of L image paths e.g. ['path/to/image1', 'path/to/image2'] 
         or directly a list of numpy arrays.
         vis_dir (Path): output folder path to save debug images
-        save_path (Path, optional): Path to save pose dictionaries. Defaults to None.
+        save_path (Union[Path, PoseStore], optional): Path to save pose dictionaries, or a PoseStore
+            the poses are appended to (named after image_names or the image index). Defaults to None.
         body_estimation (Union[Path, Body], optional): Path or loaded body model. Defaults to BODY_ESTIMATION_MODEL.
+        batch_size (int, optional): number of images sent at once to the network. Defaults to 1.
+        visualization (Union[str, VisualizationWriter], optional): "fast" draws and writes the debug images
+            with OpenCV on a background thread, "figure" saves matplotlib figures, "none" skips them.
+            A VisualizationWriter shared across calls can also be given (it is not closed). Defaults to "fast".
+        metrics (Metrics, optional): records the read, draw and write stages. Defaults to None (disabled).
+        target_height (int, optional): resolution the poses are searched at, see Body.infer_batch.
+            Defaults to None (image resolution).
 
     Returns:
         np.ndarray: array [L, 18, 3]
     """
-    # TODO : process several frames at once using the batch dimension
-
     if isinstance(vis_dir, str):
         vis_dir = Path(vis_dir)
     num_images = len(image_list)
@@ -56,100 +203,74 @@ def main(
     # Initialize model
     # ------------------------------------------------------------
     body_estimation = get_model(body_estimation)
+    writer = None
+    if isinstance(visualization, VisualizationWriter):
+        writer, visualization = visualization, "fast"
+    assert visualization in VISUALIZATIONS, f"Unknown visualization {visualization}"
+    if visualization != "none":
+        assert vis_dir.exists()
+    if metrics is None:
+        metrics = NO_METRICS
+    own_writer = visualization == "fast" and writer is None
+    if own_writer:
+        writer = VisualizationWriter(metrics=metrics)
 
     # Iterate over input images
     joints_2d = np.zeros((num_images, 18, 3))
-    for img_id in range(num_images):
-        current_img = image_list[img_id]
-        if isinstance(current_img, str) or isinstance(current_img, Path):
-            image_path = current_img
-            print("Processing {} ...".format(image_path))
-            oriImg = cv.imread(image_path) # B,G,R order
-        else:
-            oriImg = current_img
-        
+    for batch_start in range(0, num_images, batch_size):
+        batch_ids = range(batch_start, min(batch_start + batch_size, num_images))
+        batch_images = []
+        for img_id in batch_ids:
+            current_img = image_list[img_id]
+            if isinstance(current_img, str) or isinstance(current_img, Path):
+                image_path = current_img
+                print("Processing {} ...".format(image_path))
+                with metrics.timer("read"):
+                    oriImg = cv.imread(str(image_path)) # B,G,R order
+            else:
+                oriImg = current_img
+            batch_images.append(oriImg)
 
         # ------------------------------------------------------------
         # compute subsets
         # ------------------------------------------------------------
-        candidate, subset, all_peaks = body_estimation(oriImg)
-
-        # ------------------------------------------------------------
-        # Keep the most confident subset
-        # ------------------------------------------------------------
+        batch_results = body_estimation.infer_batch(batch_images, target_height=target_height)
 
-        # Initialize the person with no joint and zero confidence
-        person = -1*np.ones((20)) # no peaks
-        person[-1] = 0. # no detected joints
-        person[-2] = 0. # zero score for that person
-        c_max = 0.
-        if len(subset)>0:
-            for i in range(len(subset)):
-                if subset[i][-2]>c_max:
-                    c_max = subset[i][-2]
-                    person = subset[i]
-
-        # Assign the most confident joint peak to missing joints in person
-        for i in range(18):
-            if person[i]== -1 and len(all_peaks[i])>0:
-                # seach the peak with highest score
-                joint_peaks = all_peaks[i]
-                max_score = 0.
-                pid = -1
-                for k in range(len(joint_peaks)):
-                    if joint_peaks[k][2]>max_score:
-                        max_score = joint_peaks[k][2]
-                        pid = joint_peaks[k][3]
-                person[i] = pid
-
-        for i in range(18):
-            pid = person[i].astype(int)
-            if pid >= 0:
-                for j in range(len(all_peaks[i])):
-                    if all_peaks[i][j][3] == pid:
-                        joint_position = np.array(all_peaks[i][j][0:3]) # 1d array
-                        break
-
-                joints_2d[img_id][i] = joint_position
+        for img_id, oriImg, (candidate, subset, all_peaks) in zip(batch_ids, batch_images, batch_results):
+            joints_2d[img_id] = select_person_joints(subset, all_peaks)
 
-        # ------------------------------------------------------------
-        # Draw estimated joints on input images
-        # ------------------------------------------------------------
-        
-        canvas = copy.deepcopy(oriImg)
-        canvas = util.draw_bodypose(canvas, candidate, subset)
-
-        # ------------------------------------------------------------
-        # Save the image to file
-        # ------------------------------------------------------------
-        assert vis_dir.exists()
-        if image_names is not None:
-            im_name = image_names[img_id]
-            vis_path = vis_dir/f"{im_name}_pose.png"
-        else:
-            vis_path = vis_dir/f"{img_id:04d}_pose.png"
-        plt.figure()
-        # plt.imshow(canvas[:, :, [2, 1, 0]])
-        plt.imshow(canvas)
-        plt.axis('off')
-        plt.savefig(vis_path)
-        plt.close()
+            # ------------------------------------------------------------
+            # Draw estimated joints and save the image to file
+            # ------------------------------------------------------------
+            if visualization == "none":
+                continue
+            if image_names is not None:
+                im_name = image_names[img_id]
+                vis_path = vis_dir/f"{im_name}_pose.png"
+            else:
+                vis_path = vis_dir/f"{img_id:04d}_pose.png"
+            if writer is not None:
+                writer.put(oriImg, candidate, subset, vis_path)
+            else:
+                with metrics.timer("draw"):
+                    save_pose_visualization(oriImg, candidate, subset, vis_path)
+    if own_writer:
+        writer.close()
 
     # ------------------------------------------------------------
     # Optionally, save joint locations to file
     # ------------------------------------------------------------
-    if save_path is not None:
-        data_dict = {
-            "joint_2d_positions": joints_2d,
-            # "image_names": [basename(image_paths[i]) for i in range(num_images)]
-        }
-        if image_names is not None:
-            save_path_current = save_path/f"{image_names[img_id]}.pkl"
-        else:
-            save_path_current = save_path
-            
-        with open(save_path_current, 'wb') as f:
-            pk.dump(data_dict, f)
+    with metrics.timer("write"):
+        if isinstance(save_path, PoseStore):
+            names = image_names if image_names is not None else [f"{img_id:04d}" for img_id in range(num_images)]
+            save_path.append(names, joints_2d)
+        elif save_path is not None:
+            if image_names is not None:
+                # One pose dictionary per named image
+                for img_id in range(num_images):
+                    save_joints(joints_2d[img_id:img_id+1], Path(save_path)/f"{image_names[img_id]}.pkl")
+            else:
+                save_joints(joints_2d, save_path)
 
     return joints_2d
 
@@ -161,12 +282,22 @@ if __name__=='__main__':
     parser.add_argument(
         "vis_dir", help="Path to another folder for saving output visualization images")
     parser.add_argument(
-        "save_path", help="Path for saving output joint locations.")
+        "save_path", help="Path for saving output joint locations, a .npy path creates a PoseStore.")
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Number of images processed at once")
+    parser.add_argument(
+        "--scales", default="fast", choices=SCALES, help="Multi-scale search preset")
+    parser.add_argument(
+        "--stages", type=int, default=6, choices=range(1, 7), help="Number of CPM stages, fewer is faster")
+    parser.add_argument(
+        "--visualization", default="fast", choices=VISUALIZATIONS, help="Debug images: OpenCV (fast), matplotlib figures or none")
 
     args = parser.parse_args()
     input_dir = args.input_dir
     vis_dir = args.vis_dir
     save_path = args.save_path
+    if save_path.endswith(".npy"):
+        save_path = PoseStore(save_path, "w")
 
     # Retrieve image paths from the input image folder
     image_extensions = ("jpg", "png")
@@ -174,4 +305,8 @@ if __name__=='__main__':
     for ext in image_extensions:
         image_paths.extend(sorted(glob(join(input_dir, "*.{0:s}".format(ext)))))
 
-    main(image_paths, vis_dir, save_path)
\ No newline at end of file
+    # name the stored poses after the images
+    image_names = [Path(image_path).stem for image_path in image_paths] if isinstance(save_path, PoseStore) else None
+    main(image_paths, vis_dir, save_path, image_names=image_names, batch_size=args.batch_size, visualization=args.visualization, body_estimation=get_model(scale_search=args.scales, num_stages=args.stages))
+    if isinstance(save_path, PoseStore):
+        save_path.close()
\ No newline at end of file
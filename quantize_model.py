@@ -0,0 +1,37 @@
+from pathlib import Path
+import argparse
+import logging
+
+import cv2 as cv
+from main import BODY_ESTIMATION_MODEL, get_model
+from shared import get_image_paths
+from src.quantization import quantize_body_model, save_quantized_model
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Int8 post-training quantization of the body pose model, calibrated on a folder of sample frames")
+    parser.add_argument("-i", "--input", required=True, type=str, help="Folder of calibration images (jpg, png)")
+    parser.add_argument("-o", "--output", default=str(BODY_ESTIMATION_MODEL.with_name("body_pose_model_int8.pt")),
+                        type=str, help="Quantized model path, load it with Body(path)")
+    parser.add_argument("-m", "--model", default=str(BODY_ESTIMATION_MODEL), type=str, help="fp32 weights")
+    parser.add_argument("-n", "--max-images", type=int, default=100, help="Maximum number of calibration images")
+    parser.add_argument("--scales", default="fast", choices=["fast", "balanced", "accurate"],
+                        help="Multi-scale search preset used at inference")
+    parser.add_argument("--backend", default="x86", choices=["x86", "qnnpack"], help="Quantized engine")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    image_paths = get_image_paths(args.input)[:args.max_images]
+    assert len(image_paths) > 0, f"no calibration image found in {args.input}"
+    images = [cv.imread(image_path) for image_path in image_paths] # B,G,R order
+    body_estimation = get_model(args.model, scale_search=args.scales)
+    quantized_model = quantize_body_model(body_estimation, images, backend=args.backend)
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    save_quantized_model(quantized_model, output_path)
+    print(f"Int8 model calibrated on {len(images)} images saved to {output_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,56 @@
 import argparse
+import os
 import pickle as pk
 from os import makedirs
 from os.path import join, exists, dirname
 
-from main import main
+from main import main, VISUALIZATIONS
+
+
+def read_checkpoint(log_path):
+    """Read the (item_name, results) records of a checkpoint log.
+
+    A record truncated by a crash is dropped along with anything after it.
+
+    Returns:
+        Tuple[dict, int]: results of the logged items and the size of the valid part of the log.
+    """
+    results_dict = dict()
+    valid_size = 0
+    if not exists(log_path):
+        return results_dict, valid_size
+    with open(log_path, 'rb') as f:
+        while True:
+            try:
+                item_name, results = pk.load(f)
+            except (EOFError, pk.UnpicklingError, ValueError, AttributeError):
+                break
+            results_dict[item_name] = results
+            valid_size = f.tell()
+    return results_dict, valid_size
+
+
+def append_checkpoint(log_file, item_name, results):
+    """Append one finished item to the checkpoint log, constant cost per item."""
+    pk.dump((item_name, results), log_file)
+    log_file.flush()
+    os.fsync(log_file.fileno())
+
+
+def compact_checkpoint(log_path, save_path):
+    """Merge the logged items into save_path (written atomically), then remove the log."""
+    data = dict()
+    if exists(save_path): # items saved by previous runs
+        with open(save_path, 'rb') as f:
+            data = pk.load(f)
+    logged, _ = read_checkpoint(log_path)
+    data.update(logged)
+    tmp_path = save_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        pk.dump(data, f)
+    os.replace(tmp_path, save_path)
+    if exists(log_path):
+        os.remove(log_path)
 
 
 if __name__ == '__main__':
@@ -29,8 +76,16 @@ if __name__ == '__main__':
         help="Stop program at item # (the very last item by default).")
     parser.add_argument(
         "--save-after-each-iteration", default=False, action="store_true",
-        help="Save the output data_dict after each iteration over (video) items."
+        help="Append each finished (video) item to a checkpoint log (save_path.log), "
+        "compacted with the existing save_path into save_path at the end. "
         "Otherwise the data_dict will not be saved until all items are computed.")
+    parser.add_argument(
+        "--resume", default=False, action="store_true",
+        help="Skip the items found in the checkpoint log of an interrupted run (implies --save-after-each-iteration).")
+
+    parser.add_argument(
+        "--visualization", default="fast", choices=VISUALIZATIONS,
+        help="Debug images: OpenCV (fast), matplotlib figures or none")
 
     args = parser.parse_args()
     image_folder = args.image_folder
@@ -38,7 +93,11 @@ if __name__ == '__main__':
     save_path = args.save_path
     item_start = args.item_start
     item_end = args.item_end
-    save_after_each_iteration = args.save_after_each_iteration
+    save_after_each_iteration = args.save_after_each_iteration or args.resume
+    log_path = save_path + ".log"
+    # never overwrite the checkpoint of an interrupted run
+    assert args.resume or not (save_after_each_iteration and exists(log_path)), \
+        f"{log_path} holds the checkpoint of a previous run, use --resume to continue it or delete it to start over"
 
     # ------------------------------------------------------------
     # Load useful information
@@ -71,9 +130,18 @@ if __name__ == '__main__':
     # individual images) within image_folder
 
     results_dict = dict()
+    log_file = None
+    if save_after_each_iteration:
+        done, valid_size = read_checkpoint(log_path) if args.resume else (dict(), 0)
+        if done:
+            print("Resuming: {0:d} items found in {1:s}".format(len(done), log_path))
+        log_file = open(log_path, 'ab' if args.resume else 'wb')
+        log_file.truncate(valid_size) # drop a record truncated by a crash
 
     for i in range(item_start-1, item_end):
         item_name = item_names[i]
+        if log_file is not None and item_name in done:
+            continue
         print("  Running Openpose on item #{0:d}: {1:s} ...".format(i, item_name))
         item_length = item_lengths[i]
 
@@ -87,22 +155,17 @@ if __name__ == '__main__':
         else: # individual images
             vis_dir = vis_folder
 
-        results = main(image_paths, vis_dir, save_path=None)
+        results = main(image_paths, vis_dir, save_path=None, visualization=args.visualization)
 
         # Save estimated joint 2D positions
         results_dict[item_name] = results
 
         if save_after_each_iteration:
-            if exists(save_path):
-                with open(save_path, 'rb') as f:
-                    data = pk.load(f)
-                    data[item_name] = results
-            else:
-                data = {item_name: results}
-
-            with open(save_path, 'wb') as f:
-                pk.dump(data, f)
+            append_checkpoint(log_file, item_name, results)
 
-    if not save_after_each_iteration:
+    if save_after_each_iteration:
+        log_file.close()
+        compact_checkpoint(log_path, save_path)
+    else:
         with open(save_path, 'wb') as f:
             pk.dump(results_dict, f)
\ No newline at end of file
@@ -0,0 +1,256 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import cv2 as cv
+import numpy as np
+
+from main import BODY_ESTIMATION_MODEL, SCALES, get_model, select_person_joints
+from src.metrics import Metrics
+
+
+class PoseRequest(object):
+    """An image waiting for its pose, the client thread waits on done."""
+    __slots__ = ("image", "done", "result", "error", "arrival")
+
+    def __init__(self, image: np.ndarray):
+        self.image = image
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.arrival = time.perf_counter()
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent requests into batches for a single Body.
+
+    A batch starts with the first waiting request and closes when it holds max_batch_size
+    images or max_wait_ms after that request arrived. Only the batcher thread runs the model.
+    submit() raises queue.Full when max_queue_size requests are already waiting (backpressure).
+    """
+
+    def __init__(self, body, max_batch_size: int=8, max_wait_ms: float=10., max_queue_size: int=64,
+                 metrics: Optional[Metrics]=None):
+        self.body = body
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue(max_queue_size)
+        self.metrics = metrics
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image: np.ndarray) -> PoseRequest:
+        request = PoseRequest(image)
+        self.requests.put_nowait(request)
+        return request
+
+    def infer(self, image: np.ndarray, timeout: Optional[float]=None):
+        """(candidate, subset, all_peaks) of an image, blocks until its batch has run."""
+        request = self.submit(image)
+        if not request.done.wait(timeout):
+            raise TimeoutError("pose estimation timed out")
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self) -> List[PoseRequest]:
+        batch = [self.requests.get()]
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if self.metrics is not None:
+                self.metrics.observe("queue_wait", time.perf_counter() - batch[0].arrival, len(batch))
+            try:
+                results = self.body.infer_batch([request.image for request in batch])
+            except Exception as e:
+                logging.exception("pose estimation failed")
+                results = [None] * len(batch)
+                for request in batch:
+                    request.error = e
+            for request, result in zip(batch, results):
+                request.result = result
+                request.done.set()
+
+
+def pose_response(candidate: np.ndarray, subset: np.ndarray, all_peaks: list) -> dict:
+    """JSON serializable pose: joints [18, 3] of the most confident person, subset [P, 20] and candidate [N, 4]."""
+    return {
+        "joints": select_person_joints(subset, all_peaks).tolist(),
+        "subset": np.asarray(subset).tolist(),
+        "candidate": np.asarray(candidate).reshape(-1, 4).tolist(),
+    }
+
+
+class PoseRequestHandler(BaseHTTPRequestHandler):
+    """POST /pose with an encoded image (jpg, png) as body, GET /health and GET /metrics."""
+    batcher = None
+    metrics = None
+    timeout_s = 60.
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send_body(self, status: int, body: bytes, content_type: str="application/json", headers: dict={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, data: dict, headers: dict={}):
+        self.send_body(status, json.dumps(data).encode(), headers=headers)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok", "queued": self.batcher.requests.qsize()})
+        elif self.path == "/metrics" and self.metrics is not None:
+            self.send_body(200, self.metrics.to_prometheus().encode(), "text/plain; version=0.0.4")
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/pose":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not data:
+            self.send_json(400, {"error": "the request body is empty, send an encoded image"})
+            return
+        try:
+            image = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR) # B,G,R order
+        except cv.error:
+            image = None
+        if image is None:
+            self.send_json(400, {"error": "the request body is not an encoded image"})
+            return
+        try:
+            request = self.batcher.submit(image)
+        except queue.Full:
+            self.send_json(503, {"error": "server busy"}, headers={"Retry-After": "1"})
+            return
+        if not request.done.wait(self.timeout_s):
+            self.send_json(504, {"error": "pose estimation timed out"})
+        elif request.error is not None:
+            self.send_json(500, {"error": str(request.error)})
+        else:
+            self.send_json(200, pose_response(*request.result))
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(batcher: MicroBatcher, host: str="127.0.0.1", port: int=8000, unix_socket: Optional[str]=None,
+                metrics: Optional[Metrics]=None):
+    """HTTP server answering pose requests with batcher, on a TCP port or a unix socket."""
+    handler = type("BoundPoseRequestHandler", (PoseRequestHandler,), {"batcher": batcher, "metrics": metrics})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, unix_socket: str, timeout: float=60.):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+class PoseClient(object):
+    """Client of the pose server, only needs OpenCV and numpy (no model, no torch)."""
+
+    def __init__(self, host: str="127.0.0.1", port: int=8000, unix_socket: Optional[str]=None, timeout: float=60.):
+        self.host, self.port, self.unix_socket, self.timeout = host, port, unix_socket, timeout
+
+    def _connection(self):
+        if self.unix_socket is not None:
+            return UnixHTTPConnection(self.unix_socket, self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def infer(self, image: np.ndarray, encoding: str=".png") -> dict:
+        """Pose of an image in B,G,R order: joints [18, 3], subset [P, 20] and candidate [N, 4] arrays."""
+        ok, data = cv.imencode(encoding, image)
+        assert ok, "image encoding failed"
+        connection = self._connection()
+        try:
+            connection.request("POST", "/pose", body=data.tobytes(), headers={"Content-Type": "application/octet-stream"})
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            try:
+                error = json.loads(body)["error"]
+            except (ValueError, KeyError, TypeError):
+                error = body[:200].decode(errors="replace")
+            raise RuntimeError(f"pose server error {response.status}: {error}")
+        result = json.loads(body)
+        return {
+            "joints": np.array(result["joints"]).reshape(18, 3),
+            "subset": np.array(result["subset"]).reshape(-1, 20),
+            "candidate": np.array(result["candidate"]).reshape(-1, 4),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the body pose model over HTTP (TCP or unix socket), concurrent requests are micro-batched")
+    parser.add_argument("-m", "--model", default=str(BODY_ESTIMATION_MODEL), type=str, help="Model weights")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", type=str, default=None, help="Listen on this unix socket instead of TCP")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of images per forward pass")
+    parser.add_argument("--max-wait-ms", type=float, default=10., help="Maximum wait for a batch to fill up")
+    parser.add_argument("--max-queue-size", type=int, default=64, help="Waiting requests before answering 503")
+    parser.add_argument("--scales", default="fast", choices=SCALES, help="Multi-scale search preset")
+    parser.add_argument("--stages", type=int, default=6, choices=range(1, 7), help="Number of CPM stages, fewer is faster")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    metrics = Metrics(busy_fps=True) # the server idles between requests
+    body = get_model(args.model, scale_search=args.scales, num_stages=args.stages, metrics=metrics)
+    batcher = MicroBatcher(body, args.max_batch_size, args.max_wait_ms, args.max_queue_size, metrics=metrics)
+    server = make_server(batcher, args.host, args.port, args.unix_socket, metrics=metrics)
+    print(f"Serving poses on {args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,15 @@
 import argparse
-from typing import Tuple
+from glob import glob
+from os.path import join
+from typing import List, Tuple
 VIDEO_EXT = ["mp4", "avi", "mp4", "mov"]
+IMAGE_EXT = ["jpg", "png"]
+
+def get_image_paths(input_dir: str) -> List[str]:
+    image_paths = []
+    for ext in IMAGE_EXT:
+        image_paths.extend(sorted(glob(join(input_dir, "*.{0:s}".format(ext)))))
+    return image_paths
 
 def add_shared_parser_options(parser: argparse.Namespace) -> None:
     path_args = parser.add_argument_group("paths")
@@ -10,10 +19,28 @@ def add_shared_parser_options(parser: argparse.Namespace) -> None:
 def add_video_parser_args(parser: argparse.Namespace) ->None:
     video_args = parser.add_argument_group("input video")
     video_args.add_argument("-t", "--trim", nargs="+", type=float, help="Trim in seconds like -t 4.8 5.3 or -t 0.5")
+    video_args.add_argument("--batch-size", type=int, default=1, help="Number of frames processed at once")
+    video_args.add_argument("--scales", default="fast", choices=["fast", "balanced", "accurate"], help="Multi-scale search preset")
+    video_args.add_argument("--frame-stride", type=int, default=1, help="Process one frame every N frames (skipped frames are still decoded)")
+    video_args.add_argument("--target-fps", type=float, default=None, help="Process frames at about this framerate, overrides --frame-stride")
+    video_args.add_argument("--tracking", action="store_true", help="Run the network on a region around the previous pose")
+    video_args.add_argument("--refresh-interval", type=int, default=10, help="Full frame pass every N frames when tracking")
+    video_args.add_argument("--target-height", type=int, default=None,
+                            help="Height the poses are searched at, the decoded frames are resized once straight to the "
+                            "network input and joints are in source frame coordinates. Default: 0.2 of the frame height")
+    video_args.add_argument("--pose-format", default="pickle", choices=["pickle", "store"],
+                            help="One pickle per frame, or all the poses in a single memory-mappable poses.npy")
+    video_args.add_argument("--metrics", default=None, choices=["json", "prometheus"],
+                            help="Save stage timers, latency histograms, fps and peak memory to metrics.json / metrics.prom "
+                            "in the output directory")
+    video_args.add_argument("--pipelined", action="store_true", help="Overlap frame decoding, inference and writing")
+    video_args.add_argument("--stages", type=int, default=6, choices=range(1, 7), help="Number of CPM stages, fewer is faster")
 
 def add_visualizer_parser_args(parser: argparse.Namespace) ->None:
     viz_args = parser.add_argument_group("output visualization option")
     viz_args.add_argument("-v", "--visualize", action="store_true")
+    viz_args.add_argument("--visualization", default="fast", choices=["fast", "figure", "none"],
+                          help="Debug images: OpenCV (fast), matplotlib figures or none (nothing drawn nor written)")
     viz_args.add_argument("-fps", "--framerate", type=int, default=None, help="visualization fps, 10 if a Gif")
 
 def get_trim(args) -> Tuple[float, float]:
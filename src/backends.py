@@ -0,0 +1,204 @@
+import logging
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from src import util
+from src.model import bodypose_model, fused_bodypose_model
+
+
+class TorchBackend(object):
+    """Run bodypose_model with PyTorch (eager, compiled or TorchScript)."""
+
+    def __init__(self, model_path, channels_last=False, bf16=False, compile_mode=None, num_stages=6, fused=False):
+        """
+        Args:
+            model_path (Path): path to the body pose weights,
+                or to an int8 TorchScript model exported by quantize_model.py (CPU only).
+            channels_last (bool, optional): run the network in channels_last memory format,
+                faster for the 7x7 convolutions on CPU. Defaults to False.
+            bf16 (bool, optional): run the network under bfloat16 autocast. Defaults to False.
+            compile_mode (str, optional): "compile" builds a torch.compile graph, "torchscript" a frozen
+                TorchScript graph, once at construction. Defaults to None (eager).
+            num_stages (int, optional): number of CPM stages to run, fewer stages are faster
+                but less accurate. Defaults to 6.
+            fused (bool, optional): run the L1 and L2 branches of each stage as a single stack
+                of merged and grouped convolutions, same outputs. Defaults to False.
+        """
+        assert compile_mode in [None, "compile", "torchscript"], f"Unknown compile mode {compile_mode}"
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        if util.is_torchscript(model_path):
+            # quantized models are frozen graphs running on CPU
+            assert compile_mode is None and not bf16 and not channels_last and num_stages == 6 and not fused, \
+                "TorchScript models run as is"
+            self.device = torch.device("cpu")
+            self.model = torch.jit.load(str(model_path), map_location=self.device)
+        else:
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            if self.device.type == "cpu":
+                logging.warning('No GPU, fallback to CPU')
+            self.model = bodypose_model(num_stages)
+            # assign keeps the memory mapped tensors of converted weights instead of copying them
+            self.model.load_state_dict(load_body_weights(self.model, model_path), assign=True)
+            if fused:
+                self.model = fused_bodypose_model(self.model)
+            self.model.eval()
+            self.model = self.model.to(self.device)
+            if channels_last:
+                self.model = self.model.to(memory_format=torch.channels_last)
+            if compile_mode == "torchscript":
+                example = torch.zeros(1, 3, 184, 248, device=self.device)
+                with torch.no_grad():
+                    self.model = torch.jit.freeze(torch.jit.trace(self.model, self._prepare_input(example)))
+            elif compile_mode == "compile":
+                self.model = torch.compile(self.model, dynamic=True)
+
+    @property
+    def device_type(self):
+        return self.device.type
+
+    def _prepare_input(self, data):
+        if self.channels_last:
+            data = data.contiguous(memory_format=torch.channels_last)
+        return data
+
+    def __call__(self, im):
+        """Run the network on a [N, 3, H, W] float32 array.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: [N, 38, h, w] PAFs and [N, 19, h, w] heatmaps.
+        """
+        data = self._prepare_input(torch.from_numpy(im).to(self.device))
+        with torch.inference_mode(), torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            Mconv7_stage6_L1, Mconv7_stage6_L2 = self.model(data)
+        return Mconv7_stage6_L1.float().cpu().numpy(), Mconv7_stage6_L2.float().cpu().numpy()
+
+
+class OnnxRuntimeBackend(object):
+    """Run an exported ONNX body pose model with the ONNX Runtime CPU execution provider."""
+    device_type = "cpu"
+
+    def __init__(self, onnx_path, num_threads=None):
+        """
+        Args:
+            onnx_path (Path): ONNX model exported by export_onnx.
+            num_threads (int, optional): intra-op threads. Defaults to None (ONNX Runtime default).
+        """
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, im):
+        """Run the network on a [N, 3, H, W] float32 array.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: [N, 38, h, w] PAFs and [N, 19, h, w] heatmaps.
+        """
+        paf, heatmap = self.session.run(None, {self.input_name: np.ascontiguousarray(im, dtype=np.float32)})
+        return paf, heatmap
+
+
+def converted_weights_path(model_path):
+    """Path of the converted weights cache next to the original weights."""
+    return Path(model_path).with_suffix(".converted.pt")
+
+
+def convert_weights(model_path, output_path=None):
+    """Save the weights renamed for bodypose_model, in the zip format torch.load can memory map.
+
+    Body picks the converted weights up next to the original weights (see load_body_weights).
+    """
+    output_path = converted_weights_path(model_path) if output_path is None else Path(output_path)
+    model = bodypose_model()
+    model_dict = util.transfer(model, torch.load(model_path, map_location="cpu"))
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    torch.save({name: weights.contiguous() for name, weights in model_dict.items()}, output_path)
+    return output_path
+
+
+def load_body_weights(model, model_path):
+    """Load the state_dict of model from the original or converted weights.
+
+    The converted weights cache is used when it is more recent than model_path, zip weights files
+    are memory mapped: tensors are read lazily and their pages shared between processes.
+    """
+    model_path = Path(model_path)
+    cache_path = converted_weights_path(model_path)
+    if cache_path.exists() and cache_path.stat().st_mtime >= model_path.stat().st_mtime:
+        model_path = cache_path
+    model_weights = torch.load(model_path, map_location="cpu", weights_only=True, mmap=zipfile.is_zipfile(model_path))
+    model_names = model.state_dict().keys()
+    if all(name in model_weights for name in model_names):
+        return {name: model_weights[name] for name in model_names} # already converted
+    return util.transfer(model, model_weights)
+
+
+def export_onnx(model_path, onnx_path, opset_version=17, num_stages=6, fused=False):
+    """Export the body pose weights to ONNX, with dynamic batch size, height and width.
+
+    num_stages and fused select the exported network, see TorchBackend.
+    """
+    model = bodypose_model(num_stages)
+    model.load_state_dict(load_body_weights(model, model_path))
+    if fused:
+        model = fused_bodypose_model(model)
+    model.eval()
+    example = torch.zeros(1, 3, 184, 248)
+    dynamic_axes = {
+        "image": {0: "batch", 2: "height", 3: "width"},
+        "paf": {0: "batch", 2: "out_height", 3: "out_width"},
+        "heatmap": {0: "batch", 2: "out_height", 3: "out_width"},
+    }
+    Path(onnx_path).parent.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(model, (example,), str(onnx_path), input_names=["image"], output_names=["paf", "heatmap"],
+                          dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+    return Path(onnx_path)
+
+
+BACKENDS = ["torch", "onnxruntime"]
+# TorchBackend options applied when exporting weights to ONNX, with their defaults
+ONNX_EXPORT_OPTIONS = {"num_stages": 6, "fused": False}
+ONNX_RUNTIME_OPTIONS = ["num_threads"]
+
+
+def get_backend(model_path, backend=None, **options):
+    """Instantiate an inference backend.
+
+    Args:
+        model_path (Path): weights (.pth), TorchScript model (.pt) or ONNX model (.onnx).
+        backend (str, optional): "torch" or "onnxruntime", deduced from the model file by default.
+            PyTorch weights are exported to ONNX next to the weights when needed.
+        options: backend specific options. The onnxruntime backend also accepts num_stages and fused
+            when it exports PyTorch weights, other TorchBackend options raise a ValueError.
+    """
+    model_path = Path(model_path)
+    if backend is None:
+        backend = "onnxruntime" if model_path.suffix == ".onnx" else "torch"
+    assert backend in BACKENDS, f"Unknown backend {backend}"
+    if backend == "onnxruntime":
+        export_options = {name: options.pop(name, default) for name, default in ONNX_EXPORT_OPTIONS.items()}
+        unsupported = [name for name in options if name not in ONNX_RUNTIME_OPTIONS and options[name]]
+        if unsupported:
+            raise ValueError(f"Options {', '.join(unsupported)} are not supported by the onnxruntime backend")
+        options = {name: value for name, value in options.items() if name in ONNX_RUNTIME_OPTIONS}
+        if model_path.suffix != ".onnx":
+            # one exported model per network variant
+            variant = "" if export_options["num_stages"] == 6 else f".stages{export_options['num_stages']}"
+            variant += ".fused" if export_options["fused"] else ""
+            onnx_path = model_path.with_suffix(f"{variant}.onnx")
+            if not onnx_path.exists():
+                logging.info(f"Exporting {model_path} to {onnx_path}")
+                export_onnx(model_path, onnx_path, **export_options)
+            model_path = onnx_path
+        elif export_options != ONNX_EXPORT_OPTIONS:
+            raise ValueError(f"num_stages and fused only apply when exporting PyTorch weights, not to {model_path}")
+        return OnnxRuntimeBackend(model_path, **options)
+    return TorchBackend(model_path, **options)
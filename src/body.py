@@ -1,211 +1,631 @@
 import cv2
 import numpy as np
-import math
 import time
-from scipy.ndimage.filters import gaussian_filter
-import matplotlib.pyplot as plt
-import matplotlib
+from scipy.ndimage import gaussian_filter
 import torch
-from torchvision import transforms
+import torch.nn.functional as F
 
-from src import util
-from src.model import bodypose_model
-import logging
+from src.backends import get_backend
+from src.metrics import NO_METRICS
 
-class Body(object):
-    def __init__(self, model_path):
-        self.model = bodypose_model()
-        if torch.cuda.is_available():
-            self.model = self.model.cuda()
+# scale_search presets, relative to the 368 pixels box size
+SCALE_PRESETS = {
+    "fast": [0.5],
+    "balanced": [0.5, 0.75, 1.0],
+    "accurate": [0.5, 1.0, 1.5, 2.0],
+}
+
+
+# find connection in the specified sequence, center 29 is in the position 15
+LIMB_SEQ = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
+            [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
+            [1, 16], [16, 18], [3, 17], [6, 18]]
+# the middle joints heatmap correpondence
+MAP_IDX = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
+           [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
+           [55, 56], [37, 38], [45, 46]]
+
+
+def group_pyramid_levels(shapes, min_fill=0.5):
+    """Group pyramid levels that can share a single padded forward pass.
+
+    Levels are taken from the largest to the smallest and added to the current group
+    as long as their pixels fill at least min_fill of the padded batch.
+
+    Args:
+        shapes (list): padded (height, width) of each pyramid level.
+        min_fill (float, optional): minimal ratio of useful pixels in a group. Defaults to 0.5.
+
+    Returns:
+        list: groups of level indices.
+    """
+    groups = []
+    order = sorted(range(len(shapes)), key=lambda m: shapes[m][0] * shapes[m][1], reverse=True)
+    for m in order:
+        if groups:
+            group = groups[-1] + [m]
+            height = max(shapes[g][0] for g in group)
+            width = max(shapes[g][1] for g in group)
+            useful = sum(shapes[g][0] * shapes[g][1] for g in group)
+            if useful >= min_fill * len(group) * height * width:
+                groups[-1] = group
+                continue
+        groups.append([m])
+    return groups
+
+
+def sample_bilinear(field, x, y, channels=None):
+    """Bilinear interpolation of a [h, w, C] field at float pixel coordinates x, y (same shape).
+
+    Only the given channels are gathered at the sample points, the field is never copied.
+
+    Returns:
+        np.ndarray: [*x.shape, C] (or [*x.shape, len(channels)]) interpolated values,
+        coordinates are clamped to the field.
+    """
+    h, w = field.shape[:2]
+    x = np.clip(x, 0, w - 1)
+    y = np.clip(y, 0, h - 1)
+    x0 = np.minimum(np.floor(x).astype(int), w - 2) if w > 1 else np.zeros(x.shape, dtype=int)
+    y0 = np.minimum(np.floor(y).astype(int), h - 2) if h > 1 else np.zeros(y.shape, dtype=int)
+    x1 = np.minimum(x0 + 1, w - 1)
+    y1 = np.minimum(y0 + 1, h - 1)
+    wx = (x - x0)[..., np.newaxis]
+    wy = (y - y0)[..., np.newaxis]
+    if channels is None:
+        channels = slice(None)
+    else:
+        x0, y0, x1, y1 = x0[..., np.newaxis], y0[..., np.newaxis], x1[..., np.newaxis], y1[..., np.newaxis]
+    top = field[y0, x0, channels] * (1 - wx) + field[y0, x1, channels] * wx
+    bottom = field[y1, x0, channels] * (1 - wx) + field[y1, x1, channels] * wx
+    return top * (1 - wy) + bottom * wy
+
+
+def score_limb_candidates(candA, candB, paf, channels, image_height, thre2=0.05, mid_num=10, paf_scale=None, stride=8):
+    """Score all candA x candB pairs of a limb against its part affinity field.
+
+    Samples mid_num points along each candidate limb in a single gather of the two
+    channels of the limb and applies the same criteria as the reference per-pair implementation.
+
+    Args:
+        candA (list): peaks (x, y, score, id) of the first part of the limb.
+        candB (list): peaks (x, y, score, id) of the second part of the limb.
+        paf (np.ndarray): [H, W, 38] part affinity fields of all the limbs.
+        channels (list): (x, y) channels of the limb in paf.
+        image_height (int): height of the original image, used by the distance prior.
+        thre2 (float, optional): minimal affinity of a midpoint sample. Defaults to 0.05.
+        mid_num (int, optional): number of samples along the limb. Defaults to 10.
+        paf_scale (tuple, optional): (x, y) resize factors from the original image to the network input
+            when paf is kept at network resolution, it is then sampled by bilinear interpolation.
+            Defaults to None (paf at image resolution).
+        stride (int, optional): network output stride. Defaults to 8.
+
+    Returns:
+        list: connection candidates [i, j, score_with_dist_prior, total_score] in (i, j) order.
+    """
+    candA = np.asarray(candA, dtype=np.float64).reshape(-1, 4)
+    candB = np.asarray(candB, dtype=np.float64).reshape(-1, 4)
+    nA, nB = len(candA), len(candB)
+
+    vec = candB[np.newaxis, :, :2] - candA[:, np.newaxis, :2]  # [nA, nB, 2]
+    norm = np.sqrt(vec[..., 0] * vec[..., 0] + vec[..., 1] * vec[..., 1])
+    norm = np.maximum(0.001, norm)
+    vec = vec / norm[..., np.newaxis]
+
+    # midpoint samples [nA, nB, mid_num]
+    startX = np.broadcast_to(candA[:, np.newaxis, 0], (nA, nB))
+    startY = np.broadcast_to(candA[:, np.newaxis, 1], (nA, nB))
+    stopX = np.broadcast_to(candB[np.newaxis, :, 0], (nA, nB))
+    stopY = np.broadcast_to(candB[np.newaxis, :, 1], (nA, nB))
+    samplesX = np.linspace(startX, stopX, num=mid_num, axis=-1)
+    samplesY = np.linspace(startY, stopY, num=mid_num, axis=-1)
+
+    if paf_scale is None:
+        samplesX = np.rint(samplesX).astype(int)
+        samplesY = np.rint(samplesY).astype(int)
+        vec_x = paf[samplesY, samplesX, channels[0]]
+        vec_y = paf[samplesY, samplesX, channels[1]]
+    else:
+        # map image pixel centers to network pixel centers
+        samples = sample_bilinear(
+            paf,
+            (samplesX + 0.5) * paf_scale[0] / stride - 0.5,
+            (samplesY + 0.5) * paf_scale[1] / stride - 0.5,
+            channels)
+        vec_x = samples[..., 0]
+        vec_y = samples[..., 1]
+    score_midpts = vec_x * vec[..., 0:1] + vec_y * vec[..., 1:2]
+
+    # accumulate in sample order to match the reference sum()
+    score_sum = np.zeros((nA, nB))
+    for I in range(mid_num):
+        score_sum = score_sum + score_midpts[..., I]
+    score_with_dist_prior = score_sum / mid_num + np.minimum(0.5 * image_height / norm - 1, 0)
+    criterion1 = np.count_nonzero(score_midpts > thre2, axis=-1) > 0.8 * mid_num
+    criterion2 = score_with_dist_prior > 0
+
+    connection_candidate = []
+    for i, j in zip(*np.nonzero(np.logical_and(criterion1, criterion2))):
+        s = score_with_dist_prior[i, j]
+        connection_candidate.append([int(i), int(j), s, s + candA[i][2] + candB[j][2]])
+    return connection_candidate
+
+
+def resize_to_image(net_map, padded_shape, pad, image_shape, stride=8):
+    """Upsample a [h, w, C] network output to the original image resolution, removing padding."""
+    net_map = cv2.resize(net_map, (0, 0), fx=stride, fy=stride, interpolation=cv2.INTER_CUBIC)
+    net_map = net_map[:padded_shape[0] - pad[2], :padded_shape[1] - pad[3], :]
+    return cv2.resize(net_map, (image_shape[1], image_shape[0]), interpolation=cv2.INTER_CUBIC)
+
+
+def average_network_outputs(outputs, image_shape, stride=8):
+    """Average the multi-scale network outputs in float32 at the network resolution of the largest scale.
+
+    Args:
+        outputs (list): list over scales of (heatmap, paf, padded_shape, pad).
+        image_shape (tuple): shape of the original image.
+        stride (int, optional): network output stride. Defaults to 8.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, tuple]: [h, w, 19] heatmap, [h, w, 38] paf covering
+        the unpadded image and the (x, y) resize factors from the original image to the network input.
+    """
+    sizes = [(padded_shape[0] - pad[2], padded_shape[1] - pad[3]) for _, _, padded_shape, pad in outputs]
+    reference = max(sizes, key=lambda size: size[0] * size[1])
+    heatmap_net = np.zeros((-(-reference[0] // stride), -(-reference[1] // stride), 19), dtype=np.float32)
+    paf_net = np.zeros((heatmap_net.shape[0], heatmap_net.shape[1], 38), dtype=np.float32)
+    scale_xy = (reference[1] / image_shape[1], reference[0] / image_shape[0])
+    for (heatmap, paf, _, _), (height, width) in zip(outputs, sizes):
+        height = -(-height // stride)
+        width = -(-width // stride)
+        heatmap = np.ascontiguousarray(heatmap[:height, :width, :])
+        paf = np.ascontiguousarray(paf[:height, :width, :])
+        if heatmap.shape[:2] != heatmap_net.shape[:2]:
+            heatmap = cv2.resize(heatmap, (heatmap_net.shape[1], heatmap_net.shape[0]), interpolation=cv2.INTER_CUBIC)
+            paf = cv2.resize(paf, (paf_net.shape[1], paf_net.shape[0]), interpolation=cv2.INTER_CUBIC)
+        heatmap_net += heatmap / len(outputs)
+        paf_net += paf / len(outputs)
+    return heatmap_net, paf_net, scale_xy
+
+
+def find_peaks(heatmap_avg, thre1=0.1):
+    """Find the peaks of the 18 part heatmaps at image resolution.
+
+    Returns:
+        list: for each part, the list of peaks (x, y, score, id).
+    """
+    all_peaks = []
+    peak_counter = 0
+
+    for part in range(18):
+        map_ori = heatmap_avg[:, :, part]
+        one_heatmap = gaussian_filter(map_ori, sigma=3, output=np.float64)
+
+        map_left = np.zeros(one_heatmap.shape)
+        map_left[1:, :] = one_heatmap[:-1, :]
+        map_right = np.zeros(one_heatmap.shape)
+        map_right[:-1, :] = one_heatmap[1:, :]
+        map_up = np.zeros(one_heatmap.shape)
+        map_up[:, 1:] = one_heatmap[:, :-1]
+        map_down = np.zeros(one_heatmap.shape)
+        map_down[:, :-1] = one_heatmap[:, 1:]
+
+        peaks_binary = np.logical_and.reduce(
+            (one_heatmap >= map_left, one_heatmap >= map_right, one_heatmap >= map_up, one_heatmap >= map_down, one_heatmap > thre1))
+        peaks = list(zip(np.nonzero(peaks_binary)[1], np.nonzero(peaks_binary)[0]))  # note reverse
+        peaks_with_score = [x + (map_ori[x[1], x[0]],) for x in peaks]
+        peak_id = range(peak_counter, peak_counter + len(peaks))
+        peaks_with_score_and_id = [peaks_with_score[i] + (peak_id[i],) for i in range(len(peak_id))]
+
+        all_peaks.append(peaks_with_score_and_id)
+        peak_counter += len(peaks)
+    return all_peaks
+
+
+def find_peaks_network(heatmap, image_shape, scale_xy, stride=8, thre1=0.1, sigma=3):
+    """Find the peaks of the 18 part heatmaps directly at network resolution.
+
+    The heatmaps are blurred and filtered by a 3x3 max-pool non-maximum suppression
+    with torch ops, then peaks are refined to sub-pixel image coordinates.
+
+    Args:
+        heatmap (np.ndarray): [h, w, 19] network heatmaps covering the (unpadded) image.
+        image_shape (tuple): shape of the original image.
+        scale_xy (tuple): (x, y) resize factors from the original image to the network input.
+        stride (int, optional): network output stride. Defaults to 8.
+        thre1 (float, optional): minimal peak value. Defaults to 0.1.
+        sigma (float, optional): gaussian blur in original image pixels. Defaults to 3.
+
+    Returns:
+        list: for each part, the list of peaks (x, y, score, id).
+    """
+    maps = torch.from_numpy(np.ascontiguousarray(np.transpose(heatmap[:, :, :18], (2, 0, 1)))).float()
+    maps = maps.unsqueeze(0)  # [1, 18, h, w]
+    sigma_net = sigma * 0.5 * (scale_xy[0] + scale_xy[1]) / stride
+    radius = int(4 * sigma_net + 0.5)  # same truncation as scipy gaussian_filter
+    blurred = maps
+    if radius > 0:
+        kernel = torch.exp(-0.5 * (torch.arange(-radius, radius + 1, dtype=torch.float32) / sigma_net) ** 2)
+        kernel = (kernel / kernel.sum()).repeat(18, 1, 1, 1)
+        blurred = F.pad(blurred, (radius, radius, 0, 0), mode='replicate')
+        blurred = F.conv2d(blurred, kernel.view(18, 1, 1, -1), groups=18)
+        blurred = F.pad(blurred, (0, 0, radius, radius), mode='replicate')
+        blurred = F.conv2d(blurred, kernel.view(18, 1, -1, 1), groups=18)
+    pooled = F.max_pool2d(blurred, kernel_size=3, stride=1, padding=1)
+    peaks_binary = (blurred == pooled) & (blurred > thre1)
+    part_ids, ys, xs = torch.nonzero(peaks_binary[0], as_tuple=True)
+
+    # quadratic sub-pixel refinement on the blurred map
+    padded = F.pad(blurred, (1, 1, 1, 1), mode='replicate')[0]
+    center = padded[part_ids, ys + 1, xs + 1]
+    left, right = padded[part_ids, ys + 1, xs], padded[part_ids, ys + 1, xs + 2]
+    up, down = padded[part_ids, ys, xs + 1], padded[part_ids, ys + 2, xs + 1]
+    curvature_x = left - 2 * center + right
+    curvature_y = up - 2 * center + down
+    dx = torch.where(curvature_x < 0, 0.5 * (left - right) / curvature_x.clamp(max=-1e-12), torch.zeros_like(center))
+    dy = torch.where(curvature_y < 0, 0.5 * (up - down) / curvature_y.clamp(max=-1e-12), torch.zeros_like(center))
+    peaks_x = (xs + dx.clamp(-0.5, 0.5) + 0.5) * stride / scale_xy[0] - 0.5
+    peaks_y = (ys + dy.clamp(-0.5, 0.5) + 0.5) * stride / scale_xy[1] - 0.5
+    peaks_x = peaks_x.clamp(0, image_shape[1] - 1).tolist()
+    peaks_y = peaks_y.clamp(0, image_shape[0] - 1).tolist()
+    scores = maps[0, part_ids, ys, xs].tolist()
+    part_ids = part_ids.tolist()
+
+    all_peaks = [[] for _ in range(18)]
+    for peak_id, (part, x, y, score) in enumerate(zip(part_ids, peaks_x, peaks_y, scores)):
+        all_peaks[part].append((x, y, score, peak_id))
+    return all_peaks
+
+
+def connect_limbs(all_peaks, paf_avg, image_height, thre2=0.05, mid_num=10, paf_scale=None, stride=8):
+    """Score the candidate limbs against the part affinity fields and greedily match their peaks.
+
+    Args:
+        all_peaks (list): peaks (x, y, score, id) of each of the 18 parts.
+        paf_avg (np.ndarray): [H, W, 38] part affinity fields, see score_limb_candidates for paf_scale.
+        image_height (int): height of the original image, used by the distance prior.
+
+    Returns:
+        Tuple[list, list]: connections (peak id A, peak id B, score, i, j) of each limb of LIMB_SEQ
+        and the indices of the limbs with a part without peaks.
+    """
+    connection_all = []
+    special_k = []
+
+    for k in range(len(MAP_IDX)):
+        channels = [x - 19 for x in MAP_IDX[k]]
+        candA = all_peaks[LIMB_SEQ[k][0] - 1]
+        candB = all_peaks[LIMB_SEQ[k][1] - 1]
+        nA = len(candA)
+        nB = len(candB)
+        if (nA != 0 and nB != 0):
+            connection_candidate = score_limb_candidates(
+                candA, candB, paf_avg, channels, image_height, thre2, mid_num, paf_scale, stride)
+
+            connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
+            connection = []
+            usedA = np.zeros(nA, dtype=bool)
+            usedB = np.zeros(nB, dtype=bool)
+            for c in range(len(connection_candidate)):
+                i, j, s = connection_candidate[c][0:3]
+                if (not usedA[i] and not usedB[j]):
+                    connection.append([candA[i][3], candB[j][3], s, i, j])
+                    usedA[i] = usedB[j] = True
+                    if (len(connection) >= min(nA, nB)):
+                        break
+
+            connection_all.append(np.array(connection).reshape(-1, 5))
         else:
-            logging.warning('No GPU, fallback to CPU')
-        model_dict = util.transfer(self.model, torch.load(model_path))
-        self.model.load_state_dict(model_dict)
-        self.model.eval()
+            special_k.append(k)
+            connection_all.append([])
+    return connection_all, special_k
+
+
+def map_peaks_to_frame(all_peaks, scale_xy):
+    """Map peaks found on a resized frame back to the frame.
+
+    Args:
+        all_peaks (list): for each part, the list of peaks (x, y, score, id) on the resized frame.
+        scale_xy (tuple): (x, y) resize factors from the frame to the resized frame.
+
+    Returns:
+        list: for each part, the list of peaks (x, y, score, id) in frame coordinates.
+    """
+    # pixel centers are aligned, as in cv2.resize
+    return [[((x + 0.5) / scale_xy[0] - 0.5, (y + 0.5) / scale_xy[1] - 0.5, score, peak_id)
+             for x, y, score, peak_id in peaks] for peaks in all_peaks]
+
+
+def assemble_people(connection_all, special_k, candidate, limbSeq):
+    """Greedily group the limb connections into people.
+
+    Rows are tracked through a peak id to rows index instead of scanning every
+    existing person for each connection, and are stored in a preallocated array.
+
+    Args:
+        connection_all (list): for each limb, the [n, 5] connections (idA, idB, score, i, j).
+        special_k (list): limbs without any candidate connection.
+        candidate (np.ndarray): [N, 4] peaks (x, y, score, id).
+        limbSeq (list): parts (1-based) linked by each limb.
+
+    Returns:
+        np.ndarray: subset [P, 20], 0-17 is the index in candidate, 18 is the total score, 19 is the total parts.
+    """
+    num_connections = sum(len(connection_all[k]) for k in range(len(limbSeq)) if k not in special_k)
+    # last number in each row is the total parts number of that person
+    # the second last number in each row is the score of the overall configuration
+    subset = -1 * np.ones((num_connections, 20))
+    alive = np.zeros(num_connections, dtype=bool)
+    num_rows = 0
+    rows_of_peak = {}  # peak id -> rows holding it
+
+    def assign(row, part, peak_id):
+        previous = int(subset[row][part])
+        if previous >= 0:
+            rows_of_peak[previous].discard(row)
+        subset[row][part] = peak_id
+        rows_of_peak.setdefault(int(peak_id), set()).add(row)
+
+    for k in range(len(limbSeq)):
+        if k in special_k:
+            continue
+        connection = connection_all[k]
+        partAs = connection[:, 0]
+        partBs = connection[:, 1]
+        indexA, indexB = np.array(limbSeq[k]) - 1
+
+        for i in range(len(connection)):
+            subset_idx = sorted(rows_of_peak.get(int(partAs[i]), set()) | rows_of_peak.get(int(partBs[i]), set()))
+            found = len(subset_idx)
+
+            if found == 1:
+                j = subset_idx[0]
+                if subset[j][indexB] != partBs[i]:
+                    assign(j, indexB, partBs[i])
+                    subset[j][-1] += 1
+                    subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection[i][2]
+            elif found >= 2:  # if found 2 and disjoint, merge them
+                j1, j2 = subset_idx[:2]
+                membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
+                if len(np.nonzero(membership == 2)[0]) == 0:  # merge
+                    for part in np.nonzero(subset[j2][:-2] >= 0)[0]:
+                        assign(j1, part, subset[j2][part])
+                        rows_of_peak[int(subset[j2][part])].discard(j2)
+                    subset[j1][-2:] += subset[j2][-2:]
+                    subset[j1][-2] += connection[i][2]
+                    alive[j2] = False
+                else:  # as like found == 1
+                    assign(j1, indexB, partBs[i])
+                    subset[j1][-1] += 1
+                    subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection[i][2]
+
+            # if find no partA in the subset, create a new subset
+            elif not found and k < 17:
+                row = num_rows
+                num_rows += 1
+                alive[row] = True
+                assign(row, indexA, partAs[i])
+                assign(row, indexB, partBs[i])
+                subset[row][-1] = 2
+                subset[row][-2] = candidate[int(partAs[i]), 2] + candidate[int(partBs[i]), 2] + connection[i][2]
+
+    subset = subset[:num_rows][alive[:num_rows]]
+    # delete some rows of subset which has few parts occur
+    keep = np.logical_not(np.logical_or(subset[:, -1] < 4, subset[:, -2] / subset[:, -1] < 0.4))
+    return subset[keep]
+
+
+class Body(object):
+    def __init__(self, model_path, peak_mode="image", paf_mode="image", scale_search="fast", pyramid_min_fill=None,
+                 backend=None, metrics=None, interpolation="cubic", **backend_options):
+        """
+        Args:
+            model_path (Path): path to the body pose weights, to an int8 TorchScript model
+                exported by quantize_model.py (CPU only) or to an ONNX model.
+            peak_mode (str, optional): "image" searches heatmap peaks on full resolution upsampled maps,
+                "network" searches them on the stride-8 network output with sub-pixel refinement.
+                Defaults to "image".
+            paf_mode (str, optional): "image" upsamples the part affinity fields to the original image,
+                "network" keeps them at the stride-8 network resolution and samples them by bilinear interpolation.
+                Defaults to "image".
+            scale_search (Union[str, List[float]], optional): pyramid scales, either a list of
+                scales or one of the SCALE_PRESETS "fast", "balanced" and "accurate". Defaults to "fast".
+                With the CPU default pyramid_min_fill=0.9 no preset shares a forward pass between its levels,
+                "balanced" and "accurate" run one forward pass per scale.
+            pyramid_min_fill (float, optional): pyramid levels share a padded forward pass when their pixels
+                fill at least this ratio of it. Defaults to 0.5 on GPU and 0.9 on CPU, where padding is not free.
+            backend (str, optional): inference backend, "torch" or "onnxruntime".
+                Defaults to None (deduced from the model file).
+            metrics (Metrics, optional): records the preprocess, forward, postprocess and assembly stage timers
+                and the frame latencies. Defaults to None (disabled).
+            interpolation (str, optional): resize of the frames to the network input, "cubic" (INTER_CUBIC)
+                or "area" (INTER_AREA for the pyramid levels shrinking the frame more than 2x, less aliasing
+                on large video frames, INTER_CUBIC otherwise). Defaults to "cubic".
+            backend_options: options of the backend, see TorchBackend (channels_last, bf16, compile_mode,
+                num_stages, fused) and OnnxRuntimeBackend (num_threads).
+        """
+        assert peak_mode in ["image", "network"], f"Unknown peak mode {peak_mode}"
+        assert paf_mode in ["image", "network"], f"Unknown paf mode {paf_mode}"
+        assert interpolation in ["cubic", "area"], f"Unknown interpolation {interpolation}"
+        if isinstance(scale_search, str):
+            assert scale_search in SCALE_PRESETS, f"Unknown scale preset {scale_search}"
+            scale_search = SCALE_PRESETS[scale_search]
+        self.scale_search = list(scale_search)
+        assert len(self.scale_search) > 0 and all(scale > 0 for scale in self.scale_search), \
+            f"scale_search needs at least one positive scale, got {self.scale_search}"
+        self.peak_mode = peak_mode
+        self.paf_mode = paf_mode
+        self.interpolation = interpolation
+        self.backend = get_backend(model_path, backend, **backend_options)
+        if pyramid_min_fill is None:
+            pyramid_min_fill = 0.5 if self.backend.device_type == "cuda" else 0.9
+        self.pyramid_min_fill = pyramid_min_fill
+        self.metrics = NO_METRICS if metrics is None else metrics
+        self.buffers = {}
+
+    def _buffer(self, shape, dtype):
+        """Preallocated array reused by the next calls with the same shape (Body is not thread safe)."""
+        key = (shape, np.dtype(dtype))
+        if key not in self.buffers:
+            if len(self.buffers) >= 32: # e.g. image folders of many sizes
+                self.buffers.clear()
+            self.buffers[key] = np.empty(shape, dtype=dtype)
+        return self.buffers[key]
 
     def __call__(self, oriImg):
-        # scale_search = [0.5, 1.0, 1.5, 2.0]
-        scale_search = [0.5]
+        return self.infer_batch([oriImg])[0]
+
+    def infer_batch(self, frames, reference_height=None, target_height=None):
+        """Run pose estimation on several frames at once.
+
+        Frames sharing the same size are stacked along the batch dimension and
+        go through a single forward pass of the network.
+
+        Args:
+            frames (List[np.ndarray]): list of N images in B,G,R order.
+            reference_height (int, optional): image height the pyramid scales and the limb length prior
+                are relative to, e.g. the height of the full frame when the frames are crops of it.
+                Defaults to None (height of each frame).
+            target_height (int, optional): the network outputs are upsampled and searched at this height
+                (relative to reference_height) instead of the frame resolution, the joints are mapped back
+                to frame coordinates. Lower is faster for large frames. Defaults to None (frame resolution).
+
+        Returns:
+            List[Tuple[np.ndarray, np.ndarray, list]]: (candidate, subset, all_peaks) for each frame.
+        """
+        start = time.perf_counter()
+        results = [None] * len(frames)
+        groups = {}
+        for idx, frame in enumerate(frames):
+            groups.setdefault(frame.shape, []).append(idx)
+        for indices in groups.values():
+            batch = [frames[idx] for idx in indices]
+            for idx, outputs in zip(indices, self._forward(batch, reference_height)):
+                results[idx] = self._postprocess(frames[idx], outputs, reference_height, target_height)
+        self.metrics.add_frames(len(frames), time.perf_counter() - start)
+        return results
+
+    def _forward(self, frames, reference_height=None):
+        """Run the network on frames sharing the same size.
+
+        Pyramid levels of similar sizes are padded to a shared shape and stacked
+        with the frames into a single forward pass.
+
+        Returns:
+            list: for each frame, the list over scales of (heatmap, paf, padded_shape, pad)
+            where heatmap and paf are [h, w, C] network outputs at stride 8.
+        """
         boxsize = 368
         stride = 8
-        padValue = 128
-        thre1 = 0.1
-        thre2 = 0.05
-        multiplier = [x * boxsize / oriImg.shape[0] for x in scale_search]
-        heatmap_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 19))
-        paf_avg = np.zeros((oriImg.shape[0], oriImg.shape[1], 38))
-
-        for m in range(len(multiplier)):
-            scale = multiplier[m]
-            imageToTest = cv2.resize(oriImg, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
-            imageToTest_padded, pad = util.padRightDownCorner(imageToTest, stride, padValue)
-            im = np.transpose(np.float32(imageToTest_padded[:, :, :, np.newaxis]), (3, 2, 0, 1)) / 256 - 0.5
-            im = np.ascontiguousarray(im)
-
-            data = torch.from_numpy(im).float()
-            if torch.cuda.is_available():
-                data = data.cuda()
-            # data = data.permute([2, 0, 1]).unsqueeze(0).float()
-            with torch.no_grad():
-                Mconv7_stage6_L1, Mconv7_stage6_L2 = self.model(data)
-            Mconv7_stage6_L1 = Mconv7_stage6_L1.cpu().numpy()
-            Mconv7_stage6_L2 = Mconv7_stage6_L2.cpu().numpy()
-
-            # extract outputs, resize, and remove padding
-            # heatmap = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[1]].data), (1, 2, 0))  # output 1 is heatmaps
-            heatmap = np.transpose(np.squeeze(Mconv7_stage6_L2), (1, 2, 0))  # output 1 is heatmaps
-            heatmap = cv2.resize(heatmap, (0, 0), fx=stride, fy=stride, interpolation=cv2.INTER_CUBIC)
-            heatmap = heatmap[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
-            heatmap = cv2.resize(heatmap, (oriImg.shape[1], oriImg.shape[0]), interpolation=cv2.INTER_CUBIC)
-
-            # paf = np.transpose(np.squeeze(net.blobs[output_blobs.keys()[0]].data), (1, 2, 0))  # output 0 is PAFs
-            paf = np.transpose(np.squeeze(Mconv7_stage6_L1), (1, 2, 0))  # output 0 is PAFs
-            paf = cv2.resize(paf, (0, 0), fx=stride, fy=stride, interpolation=cv2.INTER_CUBIC)
-            paf = paf[:imageToTest_padded.shape[0] - pad[2], :imageToTest_padded.shape[1] - pad[3], :]
-            paf = cv2.resize(paf, (oriImg.shape[1], oriImg.shape[0]), interpolation=cv2.INTER_CUBIC)
-
-            heatmap_avg += heatmap_avg + heatmap / len(multiplier)
-            paf_avg += + paf / len(multiplier)
-
-        all_peaks = []
-        peak_counter = 0
-
-        for part in range(18):
-            map_ori = heatmap_avg[:, :, part]
-            one_heatmap = gaussian_filter(map_ori, sigma=3)
-
-            map_left = np.zeros(one_heatmap.shape)
-            map_left[1:, :] = one_heatmap[:-1, :]
-            map_right = np.zeros(one_heatmap.shape)
-            map_right[:-1, :] = one_heatmap[1:, :]
-            map_up = np.zeros(one_heatmap.shape)
-            map_up[:, 1:] = one_heatmap[:, :-1]
-            map_down = np.zeros(one_heatmap.shape)
-            map_down[:, :-1] = one_heatmap[:, 1:]
-
-            peaks_binary = np.logical_and.reduce(
-                (one_heatmap >= map_left, one_heatmap >= map_right, one_heatmap >= map_up, one_heatmap >= map_down, one_heatmap > thre1))
-            peaks = list(zip(np.nonzero(peaks_binary)[1], np.nonzero(peaks_binary)[0]))  # note reverse
-            peaks_with_score = [x + (map_ori[x[1], x[0]],) for x in peaks]
-            peak_id = range(peak_counter, peak_counter + len(peaks))
-            peaks_with_score_and_id = [peaks_with_score[i] + (peak_id[i],) for i in range(len(peak_id))]
-
-            all_peaks.append(peaks_with_score_and_id)
-            peak_counter += len(peaks)
-
-        # find connection in the specified sequence, center 29 is in the position 15
-        limbSeq = [[2, 3], [2, 6], [3, 4], [4, 5], [6, 7], [7, 8], [2, 9], [9, 10], \
-                   [10, 11], [2, 12], [12, 13], [13, 14], [2, 1], [1, 15], [15, 17], \
-                   [1, 16], [16, 18], [3, 17], [6, 18]]
-        # the middle joints heatmap correpondence
-        mapIdx = [[31, 32], [39, 40], [33, 34], [35, 36], [41, 42], [43, 44], [19, 20], [21, 22], \
-                  [23, 24], [25, 26], [27, 28], [29, 30], [47, 48], [49, 50], [53, 54], [51, 52], \
-                  [55, 56], [37, 38], [45, 46]]
-
-        connection_all = []
-        special_k = []
-        mid_num = 10
-
-        for k in range(len(mapIdx)):
-            score_mid = paf_avg[:, :, [x - 19 for x in mapIdx[k]]]
-            candA = all_peaks[limbSeq[k][0] - 1]
-            candB = all_peaks[limbSeq[k][1] - 1]
-            nA = len(candA)
-            nB = len(candB)
-            indexA, indexB = limbSeq[k]
-            if (nA != 0 and nB != 0):
-                connection_candidate = []
-                for i in range(nA):
-                    for j in range(nB):
-                        vec = np.subtract(candB[j][:2], candA[i][:2])
-                        norm = math.sqrt(vec[0] * vec[0] + vec[1] * vec[1])
-                        norm = max(0.001, norm)
-                        vec = np.divide(vec, norm)
-
-                        startend = list(zip(np.linspace(candA[i][0], candB[j][0], num=mid_num), \
-                                            np.linspace(candA[i][1], candB[j][1], num=mid_num)))
-
-                        vec_x = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 0] \
-                                          for I in range(len(startend))])
-                        vec_y = np.array([score_mid[int(round(startend[I][1])), int(round(startend[I][0])), 1] \
-                                          for I in range(len(startend))])
-
-                        score_midpts = np.multiply(vec_x, vec[0]) + np.multiply(vec_y, vec[1])
-                        score_with_dist_prior = sum(score_midpts) / len(score_midpts) + min(
-                            0.5 * oriImg.shape[0] / norm - 1, 0)
-                        criterion1 = len(np.nonzero(score_midpts > thre2)[0]) > 0.8 * len(score_midpts)
-                        criterion2 = score_with_dist_prior > 0
-                        if criterion1 and criterion2:
-                            connection_candidate.append(
-                                [i, j, score_with_dist_prior, score_with_dist_prior + candA[i][2] + candB[j][2]])
-
-                connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if (i not in connection[:, 3] and j not in connection[:, 4]):
-                        connection = np.vstack([connection, [candA[i][3], candB[j][3], s, i, j]])
-                        if (len(connection) >= min(nA, nB)):
-                            break
-
-                connection_all.append(connection)
-            else:
-                special_k.append(k)
-                connection_all.append([])
-
-        # last number in each row is the total parts number of that person
-        # the second last number in each row is the score of the overall configuration
-        subset = -1 * np.ones((0, 20))
-        candidate = np.array([item for sublist in all_peaks for item in sublist])
-
-        for k in range(len(mapIdx)):
-            if k not in special_k:
-                partAs = connection_all[k][:, 0]
-                partBs = connection_all[k][:, 1]
-                indexA, indexB = np.array(limbSeq[k]) - 1
-
-                for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                    found = 0
-                    subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
-                        if subset[j][indexA] == partAs[i] or subset[j][indexB] == partBs[i]:
-                            subset_idx[found] = j
-                            found += 1
-
-                    if found == 1:
-                        j = subset_idx[0]
-                        if subset[j][indexB] != partBs[i]:
-                            subset[j][indexB] = partBs[i]
-                            subset[j][-1] += 1
-                            subset[j][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-                    elif found == 2:  # if found 2 and disjoint, merge them
-                        j1, j2 = subset_idx
-                        membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
-                        if len(np.nonzero(membership == 2)[0]) == 0:  # merge
-                            subset[j1][:-2] += (subset[j2][:-2] + 1)
-                            subset[j1][-2:] += subset[j2][-2:]
-                            subset[j1][-2] += connection_all[k][i][2]
-                            subset = np.delete(subset, j2, 0)
-                        else:  # as like found == 1
-                            subset[j1][indexB] = partBs[i]
-                            subset[j1][-1] += 1
-                            subset[j1][-2] += candidate[partBs[i].astype(int), 2] + connection_all[k][i][2]
-
-                    # if find no partA in the subset, create a new subset
-                    elif not found and k < 17:
-                        row = -1 * np.ones(20)
-                        row[indexA] = partAs[i]
-                        row[indexB] = partBs[i]
-                        row[-1] = 2
-                        row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
-                        subset = np.vstack([subset, row])
-        # delete some rows of subset which has few parts occur
-        deleteIdx = []
-        for i in range(len(subset)):
-            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                deleteIdx.append(i)
-        subset = np.delete(subset, deleteIdx, axis=0)
+        oriImg = frames[0]
+        if reference_height is None:
+            reference_height = oriImg.shape[0]
+        multiplier = [x * boxsize / reference_height for x in self.scale_search]
+        outputs = [[None] * len(multiplier) for _ in frames]
+
+        # network input size of each pyramid level, before and after padding to a multiple of the stride
+        # (same rounding as cv2.resize with fx, fy)
+        sizes = [(round(oriImg.shape[0] * scale), round(oriImg.shape[1] * scale)) for scale in multiplier]
+        padded_sizes = [(-(-h // stride) * stride, -(-w // stride) * stride) for h, w in sizes]
+
+        for group in group_pyramid_levels(padded_sizes, self.pyramid_min_fill):
+            height = max(padded_sizes[m][0] for m in group)
+            width = max(padded_sizes[m][1] for m in group)
+            with self.metrics.timer("preprocess"):
+                im = self._preprocess(frames, [multiplier[m] for m in group], [sizes[m] for m in group], (height, width))
+
+            with self.metrics.timer("forward"):
+                Mconv7_stage6_L1, Mconv7_stage6_L2 = self.backend(im)
+
+            for g, m in enumerate(group):
+                for n in range(len(frames)):
+                    heatmap = np.transpose(Mconv7_stage6_L2[g * len(frames) + n], (1, 2, 0))  # output 1 is heatmaps
+                    paf = np.transpose(Mconv7_stage6_L1[g * len(frames) + n], (1, 2, 0))  # output 0 is PAFs
+                    # padding of the resized image up to the shared shape
+                    pad = [0, 0, height - sizes[m][0], width - sizes[m][1]]
+                    outputs[n][m] = (heatmap, paf, (height, width, 3), pad)
+
+        return outputs
+
+    def _preprocess(self, frames, scales, sizes, shape):
+        """Resize the frames once per pyramid level, straight into a reused and normalized network input.
+
+        Args:
+            frames (List[np.ndarray]): N frames sharing the same size.
+            scales (List[float]): resize factors of the G pyramid levels.
+            sizes (List[Tuple[int, int]]): (height, width) of the frames resized by each scale.
+            shape (Tuple[int, int]): (height, width) of the padded network input.
+
+        Returns:
+            np.ndarray: [G * N, 3, height, width] float32 network input, overwritten by the next call.
+        """
+        im = self._buffer((len(scales) * len(frames), 3) + tuple(shape), np.float32)
+        for g, (scale, (h, w)) in enumerate(zip(scales, sizes)):
+            # cubic interpolation aliases when shrinking a lot (e.g. HD video frames)
+            interpolation = cv2.INTER_AREA if self.interpolation == "area" and scale < 0.5 else cv2.INTER_CUBIC
+            for n, frame in enumerate(frames):
+                resized = cv2.resize(frame, (0, 0), dst=self._buffer((h, w, frame.shape[2]), frame.dtype),
+                                     fx=scale, fy=scale, interpolation=interpolation)
+                tensor = im[g * len(frames) + n]
+                tensor[:, :h, :w] = np.transpose(resized, (2, 0, 1))
+                tensor[:, :h, :w] *= 1 / 256
+                tensor[:, :h, :w] -= 0.5
+                # the 128 padding value is normalized to 0
+                tensor[:, h:, :] = 0
+                tensor[:, :h, w:] = 0
+        return im
+
+    def _postprocess(self, oriImg, outputs, reference_height=None, target_height=None):
+        if reference_height is None:
+            reference_height = oriImg.shape[0]
+        image_shape = oriImg.shape
+        if target_height is not None and target_height < reference_height:
+            ratio = target_height / reference_height
+            image_shape = (max(1, round(oriImg.shape[0] * ratio)), max(1, round(oriImg.shape[1] * ratio))) + oriImg.shape[2:]
+            reference_height = target_height
+
+        with self.metrics.timer("postprocess"):
+            all_peaks, connection_all, special_k = self._find_limbs(image_shape, outputs, reference_height)
+            if image_shape != oriImg.shape:
+                all_peaks = map_peaks_to_frame(
+                    all_peaks, (image_shape[1] / oriImg.shape[1], image_shape[0] / oriImg.shape[0]))
+
+        with self.metrics.timer("assembly"):
+            candidate = np.array([item for sublist in all_peaks for item in sublist])
+            subset = assemble_people(connection_all, special_k, candidate, LIMB_SEQ)
 
         # subset: n*20 array, 0-17 is the index in candidate, 18 is the total score, 19 is the total parts
         # candidate: x, y, score, id
         return candidate, subset, all_peaks
+
+    def _find_limbs(self, image_shape, outputs, reference_height=None):
+        """Peaks of each part and their connections along the limbs, see connect_limbs."""
+        stride = 8
+        thre1 = 0.1
+        thre2 = 0.05
+
+        if "network" in (self.peak_mode, self.paf_mode):
+            heatmap_net, paf_net, scale_xy = average_network_outputs(outputs, image_shape, stride)
+
+        if self.peak_mode == "network":
+            all_peaks = find_peaks_network(heatmap_net, image_shape, scale_xy, stride, thre1)
+        else:
+            heatmap_avg = np.zeros((image_shape[0], image_shape[1], 19), dtype=np.float32)
+            for heatmap, _, padded_shape, pad in outputs:
+                heatmap = resize_to_image(heatmap, padded_shape, pad, image_shape, stride)
+                heatmap_avg += heatmap / len(outputs)
+            all_peaks = find_peaks(heatmap_avg, thre1)
+
+        if self.paf_mode == "network":
+            paf_avg, paf_scale = paf_net, scale_xy
+        else:
+            paf_avg, paf_scale = np.zeros((image_shape[0], image_shape[1], 38), dtype=np.float32), None
+            for _, paf, padded_shape, pad in outputs:
+                paf = resize_to_image(paf, padded_shape, pad, image_shape, stride)
+                paf_avg += paf / len(outputs)
+
+        if reference_height is None:
+            reference_height = image_shape[0]
+        connection_all, special_k = connect_limbs(all_peaks, paf_avg, reference_height, thre2, paf_scale=paf_scale,
+                                                  stride=stride)
+        return all_peaks, connection_all, special_k
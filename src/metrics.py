@@ -0,0 +1,158 @@
+import contextlib
+import json
+import resource
+import sys
+import threading
+import time
+from pathlib import Path
+
+# latency histogram buckets in seconds, Prometheus "le" upper bounds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., float("inf")]
+METRICS_FORMATS = ["json", "prometheus"]
+
+
+class StageTimer(object):
+    """Context manager adding its duration to a stage of Metrics."""
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+class Metrics(object):
+    """Per-stage timers, per-frame latency histogram, throughput and peak memory.
+
+    Stages are timed with `with metrics.timer("forward"):`, frames are counted with
+    add_frames. A disabled Metrics (see NO_METRICS) records nothing and costs a method call per stage.
+    Thread safe: pipeline stages running in other threads can share it.
+    """
+
+    def __init__(self, enabled=True, busy_fps=False):
+        """
+        Args:
+            enabled (bool, optional): record the metrics. Defaults to True.
+            busy_fps (bool, optional): fps over the time spent processing frames (the sum of the
+                add_frames latencies) instead of the wall time since start, e.g. for a server idle
+                between requests. Defaults to False.
+        """
+        self.enabled = enabled
+        self.busy_fps = busy_fps
+        self.lock = threading.Lock()
+        self.null_timer = contextlib.nullcontext()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.last_frame_time = None
+            self.frames = 0
+            self.busy_s = 0.
+            self.stages = {}
+
+    def timer(self, stage):
+        if not self.enabled:
+            return self.null_timer
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds, count=1):
+        """Record count observations of a stage duration in seconds."""
+        if not self.enabled:
+            return
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {"count": 0, "total_s": 0., "max_s": 0., "buckets": [0] * len(LATENCY_BUCKETS)}
+            stats = self.stages[stage]
+            stats["count"] += count
+            stats["total_s"] += seconds * count
+            stats["max_s"] = max(stats["max_s"], seconds)
+            for bucket, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    stats["buckets"][bucket] += count
+                    break
+
+    def add_frames(self, count, latency):
+        """Count processed frames, each with a latency in seconds (e.g. the batch it belongs to)."""
+        if not self.enabled:
+            return
+        self.observe("frame", latency, count)
+        with self.lock:
+            self.frames += count
+            self.busy_s += latency
+            self.last_frame_time = time.perf_counter()
+
+    @staticmethod
+    def peak_memory_mb():
+        """Peak resident memory of the process and, when CUDA is used, peak allocated GPU memory."""
+        peak = {"rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024} # kilobytes on Linux
+        torch = sys.modules.get("torch") # never import torch for metrics
+        if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+            peak["cuda"] = torch.cuda.max_memory_allocated() / 2 ** 20
+        return peak
+
+    def to_dict(self):
+        with self.lock:
+            end_time = self.last_frame_time if self.last_frame_time is not None else time.perf_counter()
+            elapsed = end_time - self.start_time
+            fps_time = self.busy_s if self.busy_fps else elapsed
+            stages = {}
+            for stage, stats in self.stages.items():
+                stages[stage] = {
+                    "count": stats["count"],
+                    "total_s": stats["total_s"],
+                    "mean_ms": 1000 * stats["total_s"] / max(stats["count"], 1),
+                    "max_ms": 1000 * stats["max_s"],
+                    "histogram": {str(upper_bound): count for upper_bound, count in zip(LATENCY_BUCKETS, stats["buckets"])},
+                }
+            return {
+                "frames": self.frames,
+                "elapsed_s": elapsed,
+                "busy_s": self.busy_s,
+                "fps": self.frames / fps_time if fps_time > 0 else 0.,
+                "peak_memory_mb": self.peak_memory_mb(),
+                "stages": stages,
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix="openpose"):
+        """Metrics in the Prometheus text exposition format."""
+        data = self.to_dict()
+        lines = [
+            f"# TYPE {prefix}_frames_total counter", f"{prefix}_frames_total {data['frames']}",
+            f"# TYPE {prefix}_frames_per_second gauge", f"{prefix}_frames_per_second {data['fps']:.6f}",
+            f"# TYPE {prefix}_peak_memory_bytes gauge",
+        ]
+        for device, megabytes in data["peak_memory_mb"].items():
+            lines.append(f'{prefix}_peak_memory_bytes{{device="{device}"}} {int(megabytes * 2 ** 20)}')
+        lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+        for stage, stats in data["stages"].items():
+            cumulative = 0
+            for upper_bound, count in stats["histogram"].items():
+                cumulative += count
+                le = "+Inf" if upper_bound == "inf" else upper_bound
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stats["total_s"]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def save(self, path, metrics_format=None):
+        """Save to a .json file or to a Prometheus text file (any other suffix, e.g. .prom)."""
+        path = Path(path)
+        if metrics_format is None:
+            metrics_format = "json" if path.suffix == ".json" else "prometheus"
+        assert metrics_format in METRICS_FORMATS, f"Unknown metrics format {metrics_format}"
+        path.write_text(self.to_json() if metrics_format == "json" else self.to_prometheus())
+        return path
+
+
+# shared disabled instance, the default of Body
+NO_METRICS = Metrics(enabled=False)
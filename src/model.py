@@ -22,8 +22,15 @@ def make_layers(block, no_relu_layers):
     return nn.Sequential(OrderedDict(layers))
 
 class bodypose_model(nn.Module):
-    def __init__(self):
+    def __init__(self, num_stages=6):
+        """
+        Args:
+            num_stages (int, optional): number of CPM stages to build and run, from 1 to 6.
+                The outputs of the last built stage are returned. Defaults to 6.
+        """
         super(bodypose_model, self).__init__()
+        assert 1 <= num_stages <= 6, f"num_stages shall be within [1, 6], got {num_stages}"
+        self.num_stages = num_stages
 
         # these layers have no relu layer
         no_relu_layers = ['conv5_5_CPM_L1', 'conv5_5_CPM_L2', 'Mconv7_stage2_L1',\
@@ -72,7 +79,7 @@ class bodypose_model(nn.Module):
         self.model0 = make_layers(block0, no_relu_layers)
 
         # Stages 2 - 6
-        for i in range(2, 7):
+        for i in range(2, num_stages + 1):
             blocks['block%d_1' % i] = OrderedDict([
                     ('Mconv1_stage%d_L1' % i, [185, 128, 7, 1, 3]),
                     ('Mconv2_stage%d_L1' % i, [128, 128, 7, 1, 3]),
@@ -97,45 +104,98 @@ class bodypose_model(nn.Module):
             blocks[k] = make_layers(blocks[k], no_relu_layers)
 
         self.model1_1 = blocks['block1_1']
-        self.model2_1 = blocks['block2_1']
-        self.model3_1 = blocks['block3_1']
-        self.model4_1 = blocks['block4_1']
-        self.model5_1 = blocks['block5_1']
-        self.model6_1 = blocks['block6_1']
-
         self.model1_2 = blocks['block1_2']
-        self.model2_2 = blocks['block2_2']
-        self.model3_2 = blocks['block3_2']
-        self.model4_2 = blocks['block4_2']
-        self.model5_2 = blocks['block5_2']
-        self.model6_2 = blocks['block6_2']
+        for i in range(2, num_stages + 1):
+            setattr(self, 'model%d_1' % i, blocks['block%d_1' % i])
+            setattr(self, 'model%d_2' % i, blocks['block%d_2' % i])
 
 
     def forward(self, x):
 
         out1 = self.model0(x)
 
-        out1_1 = self.model1_1(out1)
-        out1_2 = self.model1_2(out1)
-        out2 = torch.cat([out1_1, out1_2, out1], 1)
-
-        out2_1 = self.model2_1(out2)
-        out2_2 = self.model2_2(out2)
-        out3 = torch.cat([out2_1, out2_2, out1], 1)
+        out_1 = self.model1_1(out1)
+        out_2 = self.model1_2(out1)
+
+        # stages after num_stages are not computed
+        for i in range(2, self.num_stages + 1):
+            out = torch.cat([out_1, out_2, out1], 1)
+            out_1 = getattr(self, 'model%d_1' % i)(out)
+            out_2 = getattr(self, 'model%d_2' % i)(out)
+
+        return out_1, out_2
+
+
+class fused_branches(nn.Module):
+    """Run the L1 and L2 branches of a CPM stage, which share their input, as a single stack.
+
+    The first convolutions are merged into one convolution, the following ones run as
+    grouped convolutions (groups=2) and the last one as a block diagonal convolution whose
+    output is the concatenation of the L1 and L2 outputs.
+    """
+    def __init__(self, branch_L1, branch_L2):
+        super(fused_branches, self).__init__()
+        convs_L1 = [layer for layer in branch_L1 if isinstance(layer, nn.Conv2d)]
+        convs_L2 = [layer for layer in branch_L2 if isinstance(layer, nn.Conv2d)]
+        assert len(convs_L1) == len(convs_L2)
+        self.out_L1 = convs_L1[-1].out_channels
+        # the last convolution of a branch may be followed by a relu
+        self.relu_L1 = isinstance(branch_L1[-1], nn.ReLU)
+        self.relu_L2 = isinstance(branch_L2[-1], nn.ReLU)
+
+        layers = []
+        for idx, (conv_L1, conv_L2) in enumerate(zip(convs_L1, convs_L2)):
+            last = idx == len(convs_L1) - 1
+            if idx == 0:
+                conv = nn.Conv2d(conv_L1.in_channels, conv_L1.out_channels + conv_L2.out_channels,
+                                 conv_L1.kernel_size, conv_L1.stride, conv_L1.padding)
+                weight = torch.cat([conv_L1.weight, conv_L2.weight], 0)
+            elif not last:
+                conv = nn.Conv2d(conv_L1.in_channels + conv_L2.in_channels, conv_L1.out_channels + conv_L2.out_channels,
+                                 conv_L1.kernel_size, conv_L1.stride, conv_L1.padding, groups=2)
+                weight = torch.cat([conv_L1.weight, conv_L2.weight], 0)
+            else:
+                conv = nn.Conv2d(conv_L1.in_channels + conv_L2.in_channels, conv_L1.out_channels + conv_L2.out_channels,
+                                 conv_L1.kernel_size, conv_L1.stride, conv_L1.padding)
+                weight = torch.zeros_like(conv.weight)
+                weight[:conv_L1.out_channels, :conv_L1.in_channels] = conv_L1.weight
+                weight[conv_L1.out_channels:, conv_L1.in_channels:] = conv_L2.weight
+            with torch.no_grad():
+                conv.weight.copy_(weight)
+                conv.bias.copy_(torch.cat([conv_L1.bias, conv_L2.bias], 0))
+            layers.append(conv)
+            if not last:
+                layers.append(nn.ReLU(inplace=True))
+        self.layers = nn.Sequential(*layers)
 
-        out3_1 = self.model3_1(out3)
-        out3_2 = self.model3_2(out3)
-        out4 = torch.cat([out3_1, out3_2, out1], 1)
+    def forward(self, x):
+        out = self.layers(x)
+        if self.relu_L1 or self.relu_L2:
+            out_L1, out_L2 = out[:, :self.out_L1], out[:, self.out_L1:]
+            out = torch.cat([torch.relu(out_L1) if self.relu_L1 else out_L1,
+                             torch.relu(out_L2) if self.relu_L2 else out_L2], 1)
+        return out
+
+
+class fused_bodypose_model(nn.Module):
+    """bodypose_model with the L1 and L2 branches of each stage fused, same outputs.
+
+    Build it from a bodypose_model whose weights were loaded with util.transfer.
+    """
+    def __init__(self, model):
+        super(fused_bodypose_model, self).__init__()
+        self.num_stages = model.num_stages
+        self.model0 = model.model0
+        self.out_L1 = model.model1_1[-1].out_channels
+        for i in range(1, self.num_stages + 1):
+            setattr(self, 'model%d' % i, fused_branches(getattr(model, 'model%d_1' % i), getattr(model, 'model%d_2' % i)))
 
-        out4_1 = self.model4_1(out4)
-        out4_2 = self.model4_2(out4)
-        out5 = torch.cat([out4_1, out4_2, out1], 1)
+    def forward(self, x):
 
-        out5_1 = self.model5_1(out5)
-        out5_2 = self.model5_2(out5)
-        out6 = torch.cat([out5_1, out5_2, out1], 1)
+        out1 = self.model0(x)
 
-        out6_1 = self.model6_1(out6)
-        out6_2 = self.model6_2(out6)
+        out = self.model1(out1)
+        for i in range(2, self.num_stages + 1):
+            out = getattr(self, 'model%d' % i)(torch.cat([out, out1], 1))
 
-        return out6_1, out6_2
\ No newline at end of file
+        return out[:, :self.out_L1], out[:, self.out_L1:]
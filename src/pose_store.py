@@ -0,0 +1,109 @@
+from pathlib import Path
+
+import numpy as np
+
+POSE_SHAPE = (18, 3)
+HEADER_SIZE = 128 # fixed .npy header size, leaves room for the growing row count
+
+
+def write_header(f, num_rows):
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(np.float64)), "fortran_order": False,
+              "shape": (num_rows,) + POSE_SHAPE}
+    f.seek(0)
+    np.lib.format.write_array_header_1_0(f, header)
+    assert f.tell() == HEADER_SIZE, f"Unexpected .npy header size {f.tell()}"
+
+
+class PoseStore(object):
+    """Poses of a whole video or image folder in a single memory-mappable .npy file.
+
+    path (e.g. poses.npy) holds a [N, 18, 3] float64 array of (x, y, score) joints,
+    the sidecar text file (poses.txt) holds the N frame names, one per line.
+    Rows are appended in place: the .npy header is rewritten with the new row count
+    after each append, so the file is always readable by np.load(path, mmap_mode="r").
+    """
+
+    def __init__(self, path, mode="r"):
+        """
+        Args:
+            path (Path): path to the .npy file.
+            mode (str, optional): "r" to read, "w" to create (or overwrite) and append,
+                "a" to append to an existing store. Defaults to "r".
+        """
+        assert mode in ["r", "w", "a"], f"Unknown mode {mode}"
+        self.path = Path(path)
+        self.names_path = self.path.with_suffix(".txt")
+        self.mode = mode
+        self.file = None
+        self._poses = None
+        if mode == "w" or (mode == "a" and not self.path.exists()):
+            self.names = []
+            self.file = open(self.path, "w+b")
+            write_header(self.file, 0)
+            self.names_path.write_text("")
+        else:
+            with open(self.path, "rb") as f:
+                assert np.lib.format.read_magic(f) == (1, 0), f"Not a pose store {self.path}"
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+                assert f.tell() == HEADER_SIZE and shape[1:] == POSE_SHAPE, f"Not a pose store {self.path}"
+            # names and rows appended after the last header update are dropped
+            self.names = self.names_path.read_text().splitlines()[:shape[0]]
+            assert len(self.names) == shape[0], f"Missing frame names in {self.names_path}"
+            if mode == "a":
+                self.file = open(self.path, "r+b")
+                self.file.truncate(HEADER_SIZE + len(self.names) * np.prod(POSE_SHAPE) * 8)
+                self.names_path.write_text("".join(f"{name}\n" for name in self.names))
+        self.index = {name: row for row, name in enumerate(self.names)}
+
+    def append(self, names, joints_2d):
+        """Append the [L, 18, 3] joints of L frames named names."""
+        assert self.file is not None, "Store opened in read mode"
+        joints_2d = np.asarray(joints_2d, dtype=np.float64).reshape((-1,) + POSE_SHAPE)
+        names = [str(name) for name in names]
+        assert len(names) == len(joints_2d)
+        assert all("\n" not in name for name in names)
+        self.file.seek(0, 2)
+        self.file.write(np.ascontiguousarray(joints_2d).tobytes())
+        with open(self.names_path, "a") as f:
+            f.write("".join(f"{name}\n" for name in names))
+        for name in names:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        write_header(self.file, len(self.names))
+        self.file.flush()
+        self._poses = None
+
+    @property
+    def poses(self):
+        """[N, 18, 3] memory map of all the stored poses."""
+        if self._poses is None:
+            if self.file is not None:
+                self.file.flush()
+            self._poses = np.load(self.path, mmap_mode="r")[:len(self.names)]
+        return self._poses
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self._key(name) in self.index
+
+    def __getitem__(self, name):
+        """[18, 3] joints of a frame, int names are video frame indices."""
+        return self.poses[self.index[self._key(name)]]
+
+    @staticmethod
+    def _key(name):
+        return f"{name:04d}" if isinstance(name, (int, np.integer)) else str(name)
+
+    def close(self):
+        self._poses = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,50 @@
+import copy
+import logging
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from src.backends import TorchBackend
+from src.body import Body
+
+
+def quantize_body_model(body: Body, calibration_images, backend="x86"):
+    """Int8 post-training static quantization of the body pose network (FX graph mode).
+
+    The observers are calibrated by running the regular Body preprocessing and
+    forward pass on the calibration images, on a copy of the network: body is left unchanged.
+
+    Args:
+        body (Body): fp32 body model, eager and without bf16 autocast.
+        calibration_images (List[np.ndarray]): sample frames in B,G,R order.
+        backend (str, optional): quantized engine, "x86" or "qnnpack" (ARM). Defaults to "x86".
+
+    Returns:
+        torch.jit.ScriptModule: frozen TorchScript int8 model, runs on CPU.
+    """
+    assert isinstance(body.backend, TorchBackend) and not body.backend.bf16, "calibrate the fp32 torch model"
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(body.backend.model).to("cpu")
+    example_inputs = (torch.zeros(1, 3, 184, 248),)
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs)
+
+    # calibration, the Body runs the observed copy until it is restored
+    original = body.backend.model, body.backend.device, body.backend.channels_last
+    body.backend.model, body.backend.device, body.backend.channels_last = prepared, torch.device("cpu"), False
+    try:
+        for idx, image in enumerate(calibration_images):
+            logging.info(f"calibration image {idx + 1}/{len(calibration_images)}")
+            body._forward([image])
+    finally:
+        body.backend.model, body.backend.device, body.backend.channels_last = original
+
+    quantized = convert_fx(prepared)
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, example_inputs)
+    return torch.jit.freeze(traced)
+
+
+def save_quantized_model(quantized_model, output_path):
+    """Save an int8 model, Body(output_path) loads it directly."""
+    torch.jit.save(quantized_model, str(output_path))
@@ -0,0 +1,110 @@
+import logging
+
+import numpy as np
+
+
+def pose_bounding_box(candidate, subset):
+    """Bounding box (x0, y0, x1, y1) of the joints of all the people in subset, None if there is none."""
+    joints = subset[:, :18].astype(int).flatten() if len(subset) > 0 else []
+    joints = [joint for joint in joints if joint >= 0]
+    if len(joints) == 0:
+        return None
+    points = np.asarray(candidate)[joints, :2]
+    x0, y0 = points.min(axis=0)
+    x1, y1 = points.max(axis=0)
+    return x0, y0, x1, y1
+
+
+def shift_pose(candidate, all_peaks, x_offset, y_offset):
+    """Move the peaks found in a crop back to the coordinates of the full frame."""
+    candidate = np.array(candidate)
+    if len(candidate) > 0:
+        candidate[:, 0] += x_offset
+        candidate[:, 1] += y_offset
+    all_peaks = [[(peak[0] + x_offset, peak[1] + y_offset) + tuple(peak[2:]) for peak in part]
+                 for part in all_peaks]
+    return candidate, all_peaks
+
+
+def person_confidence(subset):
+    """Score of the most confident person, 0 when nobody is found."""
+    return float(subset[:, -2].max()) if len(subset) > 0 else 0.
+
+
+class PoseTracker(object):
+    """Run Body on a region of interest around the pose found in the previous frame.
+
+    A full frame pass runs every refresh_interval frames, when nobody was found,
+    or when the confidence of the tracked pose drops.
+    Frames must be given in temporal order.
+    """
+
+    def __init__(self, body, refresh_interval=10, margin=0.5, min_confidence_ratio=0.7, max_roi_fill=0.6):
+        """
+        Args:
+            body (Body): loaded body model.
+            refresh_interval (int, optional): run a full frame pass every refresh_interval frames. Defaults to 10.
+            margin (float, optional): padding added on each side of the pose bounding box,
+                relative to its largest side. Defaults to 0.5.
+            min_confidence_ratio (float, optional): a crop result whose best person score is below this ratio
+                of the score found by the last full frame pass is discarded for a full frame pass. Defaults to 0.7.
+            max_roi_fill (float, optional): the full frame is used when the region of interest
+                covers more than this ratio of its area. Defaults to 0.6.
+        """
+        assert refresh_interval >= 1
+        self.body = body
+        self.refresh_interval = refresh_interval
+        self.margin = margin
+        self.min_confidence_ratio = min_confidence_ratio
+        self.max_roi_fill = max_roi_fill
+        self.full_passes = 0
+        self.crop_passes = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the tracked pose, the next frame gets a full frame pass."""
+        self.roi = None
+        self.frames_since_full = 0
+        self.reference_confidence = 0.
+
+    def __call__(self, oriImg, target_height=None):
+        if self.roi is not None and self.frames_since_full < self.refresh_interval:
+            x0, y0, x1, y1 = self.roi
+            candidate, subset, all_peaks = self.body.infer_batch(
+                [oriImg[y0:y1, x0:x1]], reference_height=oriImg.shape[0], target_height=target_height)[0]
+            self.crop_passes += 1
+            if person_confidence(subset) >= self.min_confidence_ratio * self.reference_confidence:
+                candidate, all_peaks = shift_pose(candidate, all_peaks, x0, y0)
+                self.frames_since_full += 1
+                self._update_roi(oriImg.shape, candidate, subset)
+                return candidate, subset, all_peaks
+            logging.info(f"tracked pose lost ({person_confidence(subset):.2f}), full frame pass")
+
+        candidate, subset, all_peaks = self.body.infer_batch([oriImg], target_height=target_height)[0]
+        self.full_passes += 1
+        self.frames_since_full = 0
+        self.reference_confidence = person_confidence(subset)
+        self._update_roi(oriImg.shape, candidate, subset)
+        return candidate, subset, all_peaks
+
+    def infer_batch(self, frames, target_height=None):
+        """Same interface as Body.infer_batch, frames are tracked one after the other."""
+        return [self(frame, target_height) for frame in frames]
+
+    def _update_roi(self, image_shape, candidate, subset):
+        box = pose_bounding_box(candidate, subset)
+        if box is None:
+            self.roi = None
+            return
+        x0, y0, x1, y1 = box
+        pad = self.margin * max(x1 - x0, y1 - y0)
+        height, width = image_shape[:2]
+        x0, y0 = max(0, int(x0 - pad)), max(0, int(y0 - pad))
+        x1, y1 = min(width, int(np.ceil(x1 + pad)) + 1), min(height, int(np.ceil(y1 + pad)) + 1)
+        if (x1 - x0) * (y1 - y0) > self.max_roi_fill * width * height:
+            self.roi = None
+        else:
+            self.roi = (x0, y0, x1, y1)
+
+    def stats(self):
+        return {"full_passes": self.full_passes, "crop_passes": self.crop_passes}
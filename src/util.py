@@ -1,12 +1,7 @@
 import numpy as np
 import math
 import cv2
-import matplotlib
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-import numpy as np
-import matplotlib.pyplot as plt
-import cv2
+import zipfile
 
 
 def padRightDownCorner(img, stride, padValue):
@@ -19,18 +14,18 @@ def padRightDownCorner(img, stride, padValue):
     pad[2] = 0 if (h % stride == 0) else stride - (h % stride) # down
     pad[3] = 0 if (w % stride == 0) else stride - (w % stride) # right
 
-    img_padded = img
-    pad_up = np.tile(img_padded[0:1, :, :]*0 + padValue, (pad[0], 1, 1))
-    img_padded = np.concatenate((pad_up, img_padded), axis=0)
-    pad_left = np.tile(img_padded[:, 0:1, :]*0 + padValue, (1, pad[1], 1))
-    img_padded = np.concatenate((pad_left, img_padded), axis=1)
-    pad_down = np.tile(img_padded[-2:-1, :, :]*0 + padValue, (pad[2], 1, 1))
-    img_padded = np.concatenate((img_padded, pad_down), axis=0)
-    pad_right = np.tile(img_padded[:, -2:-1, :]*0 + padValue, (1, pad[3], 1))
-    img_padded = np.concatenate((img_padded, pad_right), axis=1)
+    img_padded = np.full((h + pad[0] + pad[2], w + pad[1] + pad[3]) + img.shape[2:], padValue, dtype=img.dtype)
+    img_padded[pad[0]:pad[0] + h, pad[1]:pad[1] + w] = img
 
     return img_padded, pad
 
+# TorchScript archives (e.g. int8 models) hold their code next to the weights
+def is_torchscript(model_path):
+    if not zipfile.is_zipfile(model_path):
+        return False
+    with zipfile.ZipFile(model_path) as archive:
+        return any(name.split('/')[1:2] == ['code'] for name in archive.namelist())
+
 # transfer caffe model to pytorch which will match the layer name
 def transfer(model, model_weights):
     transfered_model_weights = {}
@@ -60,7 +55,6 @@ def draw_bodypose(canvas, candidate, subset):
             index = subset[n][np.array(limbSeq[i]) - 1]
             if -1 in index:
                 continue
-            cur_canvas = canvas.copy()
             Y = candidate[index.astype(int), 0]
             X = candidate[index.astype(int), 1]
             mX = np.mean(X)
@@ -68,8 +62,15 @@ def draw_bodypose(canvas, candidate, subset):
             length = ((X[0] - X[1]) ** 2 + (Y[0] - Y[1]) ** 2) ** 0.5
             angle = math.degrees(math.atan2(X[0] - X[1], Y[0] - Y[1]))
             polygon = cv2.ellipse2Poly((int(mY), int(mX)), (int(length / 2), stickwidth), int(angle), 0, 360, 1)
-            cv2.fillConvexPoly(cur_canvas, polygon, colors[i])
-            canvas = cv2.addWeighted(canvas, 0.4, cur_canvas, 0.6, 0)
+            # blending leaves the pixels outside of the limb unchanged: only blend its bounding box
+            x0, y0 = np.maximum(polygon.min(axis=0), 0)
+            x1, y1 = np.maximum(polygon.max(axis=0) + 1, 0)
+            roi = canvas[y0:y1, x0:x1]
+            if roi.size == 0:
+                continue
+            cur_canvas = roi.copy()
+            cv2.fillConvexPoly(cur_canvas, polygon - np.array([x0, y0], dtype=polygon.dtype), colors[i])
+            canvas[y0:y1, x0:x1] = cv2.addWeighted(roi, 0.4, cur_canvas, 0.6, 0)
     # plt.imsave("preview.jpg", canvas[:, :, [2, 1, 0]])
     # plt.imshow(canvas[:, :, [2, 1, 0]])
     return canvas
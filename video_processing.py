@@ -1,67 +1,358 @@
 from pathlib import Path
 import argparse
+import queue
+import threading
+import time
 
-from moviepy.editor import VideoFileClip
 import numpy as np
-from main import main as main_processing, get_model
+from main import main as main_processing, get_model, save_joints, save_pose_image, save_pose_visualization, select_person_joints
+from main import VisualizationWriter
+from src.tracking import PoseTracker
+from src.pose_store import PoseStore
+from src.metrics import Metrics, NO_METRICS
 from cv2 import resize, rotate, ROTATE_90_CLOCKWISE, ROTATE_90_COUNTERCLOCKWISE, ROTATE_180
-from typing import List, Union, Optional, Tuple
+from typing import Iterator, List, Union, Optional, Tuple
 import logging
 from shared import add_shared_parser_options, add_video_parser_args, add_visualizer_parser_args, get_trim
 from visualize_results import encode_debug_figures
 
-def process_video_frames(
+# default pose search height relative to the frame height (frames used to be shrunk by this factor first)
+TARGET_SCALE = 0.2
+
+class StageQueue(queue.Queue):
+    """Bounded queue between two pipeline stages.
+
+    Records its depth and how long the producer and the consumer waited on it:
+    a full queue with a waiting producer points at a slow consumer and vice versa.
+    """
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self.depths = []
+        self.producer_wait = 0.
+        self.consumer_wait = 0.
+
+    def put(self, item, block=True, timeout=None):
+        start = time.perf_counter()
+        super().put(item, block, timeout)
+        self.producer_wait += time.perf_counter() - start
+        self.depths.append(self.qsize())
+
+    def get(self, block=True, timeout=None):
+        start = time.perf_counter()
+        item = super().get(block, timeout)
+        self.consumer_wait += time.perf_counter() - start
+        return item
+
+    def stats(self) -> dict:
+        return {
+            "mean_depth": float(np.mean(self.depths)) if self.depths else 0.,
+            "max_depth": max(self.depths, default=0),
+            "capacity": self.maxsize,
+            "producer_wait_s": self.producer_wait,
+            "consumer_wait_s": self.consumer_wait,
+        }
+
+
+def get_frame_stride(fps: float, frame_stride: int=1, target_fps: Optional[float]=None) -> int:
+    """Number of source frames between two processed frames, target_fps overrides frame_stride."""
+    if target_fps is not None:
+        assert target_fps > 0
+        return max(1, int(round(fps / target_fps)))
+    assert frame_stride >= 1
+    return frame_stride
+
+
+def get_target_height(frame_shape: Tuple[int, ...], target_height: Optional[int]=None) -> int:
+    """Height the poses of a frame are searched at, TARGET_SCALE of the frame height by default."""
+    if target_height is not None:
+        return target_height
+    return max(1, round(TARGET_SCALE * frame_shape[0]))
+
+
+def attach_metrics(model, metrics: Metrics) -> None:
+    """Record the stages of the Body of model (a Body or a PoseTracker) in metrics."""
+    body = model.body if isinstance(model, PoseTracker) else model
+    body.metrics = metrics
+
+
+def decode_frames(
         video_path: Path,
-        visualization_dir:Path,
         trim: Optional[Tuple[Union[int, None], Union[int, None]]]=None,
         rotation=None,
-        model=None,
-    ) -> List[np.ndarray]:
-    """Run open pose (decode video using MoviePy)
+        frame_stride: int=1,
+        target_fps: Optional[float]=None,
+        metrics: Optional[Metrics]=None,
+        resize_factor: Optional[float]=None,
+    ) -> Iterator[Tuple[int, np.ndarray]]:
+    """Decode, rotate and resize the video frames (decode video using MoviePy)
+
+    Only the needed frames are converted and yielded: the reader seeks to the trim start,
+    and the frames between two strided frames are skipped without being converted to arrays.
+    ffmpeg still decodes the skipped frames (MoviePy only seeks more than 100 frames ahead),
+    so a stride saves the inference time of the skipped frames, not their decoding time.
 
     Args:
-        video_path (Path):  Path to the video file.
+        frame_stride (int, optional): process one frame every frame_stride frames. Defaults to 1.
+        target_fps (float, optional): process frames at about this framerate, overrides frame_stride. Defaults to None.
+        metrics (Metrics, optional): records the decode stage. Defaults to None (disabled).
+        resize_factor (float, optional): frames are resized by this factor, None keeps the decoded resolution
+            (Body resizes them once, straight to the network input). Defaults to None.
 
+    Yields:
+        Tuple[int, np.ndarray]: frame index (in the source video) and frame.
     """
-    # @TODO: skip frames until start without decoding (directly in moviepy?)
-    # @TODO: export pose estimation debug videos.
-    poses = []
+    # moviepy.editor imports most of moviepy (and matplotlib), import what is needed when it is needed
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+    from moviepy.video.fx.resize import resize as resize_clip
+    if metrics is None:
+        metrics = NO_METRICS
     with VideoFileClip(str(video_path)) as video:
         if video.rotation in (90, 270): # Support vertical videos
             # https://github.com/Zulko/moviepy/issues/586
-            video = video.resize(video.size[::-1])
+            video = resize_clip(video, video.size[::-1])
             video.rotation = 0
-        start, end = None, None
+        # same timestamps as video.iter_frames()
+        timestamps = np.arange(0, video.duration, 1.0/video.fps)
+        first, last = 0, len(timestamps) - 1
         if trim is not None:
             assert len(trim) == 2
             start, end = trim
             if start is not None:
-                start = int(start*video.fps)
+                first = int(start*video.fps) + 1
             if end is not None:
-                end = int(end*video.fps)
-        for frame_idx, frame in enumerate(video.iter_frames()):
-            if end is not None and frame_idx>end:
-                logging.info(f"LAST FRAME REACHED! {frame_idx}>{end}")
-                break
-            if start is not None and frame_idx<= start:
-                continue
-            if rotation is not None:
-                assert rotation in [ROTATE_90_CLOCKWISE, ROTATE_90_COUNTERCLOCKWISE, ROTATE_180]
-                frame=rotate(frame, rotateCode=rotation)
-            frame = resize(frame, (0, 0), fx=0.2, fy=0.2)
+                last = min(last, int(end*video.fps))
+        stride = get_frame_stride(video.fps, frame_stride, target_fps)
+        for frame_idx in range(first, last + 1, stride):
+            with metrics.timer("decode"):
+                # MoviePy seeks when jumping more than 100 frames ahead, otherwise ffmpeg decodes the skipped frames
+                frame = video.get_frame(timestamps[frame_idx])
+                if rotation is not None:
+                    assert rotation in [ROTATE_90_CLOCKWISE, ROTATE_90_COUNTERCLOCKWISE, ROTATE_180]
+                    frame=rotate(frame, rotateCode=rotation)
+                if resize_factor is not None:
+                    frame = resize(frame, (0, 0), fx=resize_factor, fy=resize_factor)
             logging.info(f"processing frame ={frame_idx:04d} | {frame.shape[0]} x {frame.shape[1]}")
-            if model is None:
-                model = get_model() #Load the model when needed.
-            pose = main_processing(
-                [frame],
-                visualization_dir,
-                body_estimation=model,
-                image_names=[f"{frame_idx:04d}",],
-                save_path=visualization_dir
-            )
-            poses.append(pose[0, ...])
+            yield frame_idx, frame
+
+
+def process_video_frames(
+        video_path: Path,
+        visualization_dir:Path,
+        trim: Optional[Tuple[Union[int, None], Union[int, None]]]=None,
+        rotation=None,
+        model=None,
+        batch_size: int=1,
+        pipelined: bool=False,
+        queue_size: int=8,
+        frame_stride: int=1,
+        target_fps: Optional[float]=None,
+        tracking: bool=False,
+        refresh_interval: int=10,
+        visualization: str="fast",
+        pose_format: str="pickle",
+        metrics: Optional[Metrics]=None,
+        target_height: Optional[int]=None,
+    ) -> List[np.ndarray]:
+    """Run open pose (decode video using MoviePy)
+
+    Args:
+        video_path (Path):  Path to the video file.
+        batch_size (int, optional): number of frames sent at once to the network. Defaults to 1.
+        frame_stride (int, optional): process one frame every frame_stride frames. Defaults to 1.
+        target_fps (float, optional): process frames at about this framerate, overrides frame_stride. Defaults to None.
+        pipelined (bool, optional): decode, infer and write frames in 3 concurrent stages. Defaults to False.
+        queue_size (int, optional): capacity of the queues between pipeline stages. Defaults to 8.
+        tracking (bool, optional): run the network on a region around the pose of the previous frame,
+            see PoseTracker. Defaults to False.
+        refresh_interval (int, optional): full frame pass every refresh_interval frames when tracking. Defaults to 10.
+        visualization (str, optional): debug images, "fast" (OpenCV), "figure" (matplotlib) or "none".
+            Defaults to "fast".
+        pose_format (str, optional): "pickle" saves one {frame}.pkl file per frame,
+            "store" appends all the poses to a single PoseStore (poses.npy and poses.txt). Defaults to "pickle".
+        metrics (Metrics, optional): records the decode, Body, draw and write stages, see Metrics. Defaults to None.
+        target_height (int, optional): frames go from their decoded resolution to the network input in a single
+            resize and the poses are searched at this height, joints are in source frame coordinates
+            and debug images are drawn on the source frames. Defaults to None (TARGET_SCALE of the frame height).
+            Models loaded here shrink the frames with area interpolation, see Body.
+
+    """
+    # @TODO: export pose estimation debug videos.
+    if tracking:
+        if model is None:
+            model = get_model(interpolation="area")
+        model = PoseTracker(model, refresh_interval=refresh_interval)
+    if pipelined:
+        return process_video_frames_pipelined(
+            video_path, visualization_dir, trim=trim, rotation=rotation, model=model,
+            batch_size=batch_size, queue_size=queue_size, frame_stride=frame_stride, target_fps=target_fps,
+            visualization=visualization, pose_format=pose_format, metrics=metrics, target_height=target_height)
+    assert pose_format in ["pickle", "store"], f"Unknown pose format {pose_format}"
+    save_path = PoseStore(Path(visualization_dir)/"poses.npy", "w") if pose_format == "store" else visualization_dir
+    if visualization == "fast":
+        visualization = VisualizationWriter(metrics=metrics) # shared by all batches
+    poses = []
+    frames, frame_names = [], []
+
+    def flush_frames():
+        nonlocal model
+        if len(frames) == 0:
+            return
+        if model is None:
+            model = get_model(interpolation="area") #Load the model when needed.
+        if metrics is not None:
+            attach_metrics(model, metrics)
+        pose = main_processing(
+            frames,
+            visualization_dir,
+            body_estimation=model,
+            image_names=frame_names,
+            save_path=save_path,
+            batch_size=batch_size,
+            visualization=visualization,
+            metrics=metrics,
+            target_height=get_target_height(frames[0].shape, target_height)
+        )
+        poses.extend(pose)
+        frames.clear()
+        frame_names.clear()
+
+    for frame_idx, frame in decode_frames(video_path, trim=trim, rotation=rotation,
+                                          frame_stride=frame_stride, target_fps=target_fps, metrics=metrics):
+        frames.append(frame)
+        frame_names.append(f"{frame_idx:04d}")
+        if len(frames) >= batch_size:
+            flush_frames()
+    flush_frames()
+    if isinstance(visualization, VisualizationWriter):
+        visualization.close()
+    if isinstance(save_path, PoseStore):
+        save_path.close()
+    if tracking:
+        print(f"Tracking | {model.stats()}")
+    return poses
+
+
+def process_video_frames_pipelined(
+        video_path: Path,
+        visualization_dir:Path,
+        trim: Optional[Tuple[Union[int, None], Union[int, None]]]=None,
+        rotation=None,
+        model=None,
+        batch_size: int=1,
+        queue_size: int=8,
+        frame_stride: int=1,
+        target_fps: Optional[float]=None,
+        visualization: str="fast",
+        pose_format: str="pickle",
+        metrics: Optional[Metrics]=None,
+        target_height: Optional[int]=None,
+    ) -> List[np.ndarray]:
+    """Same outputs as process_video_frames, with decoding and writing overlapping inference.
+
+    A decoder thread feeds the inference stage (calling thread), which feeds a writer thread
+    drawing and saving the results, through bounded queues. Queue statistics are printed at the end.
+    """
+    if model is None:
+        model = get_model(interpolation="area") #Load the model when needed.
+    if metrics is None:
+        metrics = NO_METRICS
+    else:
+        attach_metrics(model, metrics)
+    assert pose_format in ["pickle", "store"], f"Unknown pose format {pose_format}"
+    store = PoseStore(Path(visualization_dir)/"poses.npy", "w") if pose_format == "store" else None
+    decoded, to_write = StageQueue(queue_size), StageQueue(queue_size)
+    errors = []
+    stop = threading.Event() # set when inference stops, the decoder must not block on a full queue
+
+    def put_decoded(item) -> bool:
+        while not stop.is_set():
+            try:
+                decoded.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decoder():
+        frames = decode_frames(video_path, trim=trim, rotation=rotation,
+                               frame_stride=frame_stride, target_fps=target_fps, metrics=metrics)
+        try:
+            for item in frames:
+                if not put_decoded(item):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            frames.close() # closes the video reader (and its ffmpeg process)
+            put_decoded(None)
+
+    def writer():
+        while True:
+            item = to_write.get()
+            if item is None:
+                break
+            if errors:
+                continue # keep draining to never block inference
+            frame_name, frame, candidate, subset, joints = item
+            try:
+                with metrics.timer("draw"):
+                    if visualization == "fast":
+                        save_pose_image(frame, candidate, subset, Path(visualization_dir)/f"{frame_name}_pose.png")
+                    elif visualization == "figure":
+                        save_pose_visualization(frame, candidate, subset, Path(visualization_dir)/f"{frame_name}_pose.png")
+                with metrics.timer("write"):
+                    if store is not None:
+                        store.append([frame_name], joints[np.newaxis])
+                    else:
+                        save_joints(joints[np.newaxis], Path(visualization_dir)/f"{frame_name}.pkl")
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=decoder, daemon=True), threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    poses, batch = [], []
+
+    def infer(batch):
+        results = model.infer_batch([frame for _, frame in batch],
+                                    target_height=get_target_height(batch[0][1].shape, target_height))
+        for (frame_idx, frame), (candidate, subset, all_peaks) in zip(batch, results):
+            joints = select_person_joints(subset, all_peaks)
+            poses.append(joints)
+            to_write.put((f"{frame_idx:04d}", frame, candidate, subset, joints))
+
+    try:
+        while not errors:
+            item = decoded.get()
+            if item is None:
+                break
+            batch.append(item)
+            if len(batch) >= batch_size:
+                infer(batch)
+                batch = []
+        if batch and not errors:
+            infer(batch)
+    finally:
+        stop.set()
+        threads[0].join()
+        to_write.put(None)
+        threads[1].join()
+        if store is not None:
+            store.close()
+    if errors:
+        raise errors[0]
+    print(f"Pipeline queues | decode->infer {decoded.stats()} | infer->write {to_write.stats()}")
+    if isinstance(model, PoseTracker):
+        print(f"Tracking | {model.stats()}")
     return poses
 
+def save_metrics(metrics: Metrics, out_dir: Path, metrics_format: str) -> Path:
+    """Save metrics to metrics.json or metrics.prom (Prometheus text format) in out_dir."""
+    suffix = ".json" if metrics_format == "json" else ".prom"
+    return metrics.save(Path(out_dir)/f"metrics{suffix}", metrics_format)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Run Openpose on a video")
@@ -69,6 +360,7 @@ def main():
     add_video_parser_args(parser)
     add_visualizer_parser_args(parser)
     args = parser.parse_args()
+    assert not (args.visualize and args.visualization == "none"), "-v needs debug images, use --visualization fast"
     video_path = Path(args.input)
     assert video_path.exists()
     out_dir = args.output_dir
@@ -76,7 +368,14 @@ def main():
         out_dir = video_path.parent / video_path.stem
         out_dir.mkdir(parents=True, exist_ok=True)
     trim = get_trim(args)
-    process_video_frames(video_path, visualization_dir=out_dir, trim=trim, rotation=None)
+    metrics = Metrics() if args.metrics else None
+    process_video_frames(video_path, visualization_dir=out_dir, trim=trim, rotation=None,
+                         model=get_model(scale_search=args.scales, num_stages=args.stages, interpolation="area"), batch_size=args.batch_size,
+                         pipelined=args.pipelined, frame_stride=args.frame_stride, target_fps=args.target_fps,
+                         tracking=args.tracking, refresh_interval=args.refresh_interval, visualization=args.visualization,
+                         pose_format=args.pose_format, metrics=metrics, target_height=args.target_height)
+    if metrics is not None:
+        print(f"Metrics saved to {save_metrics(metrics, out_dir, args.metrics)}")
     if args.visualize:
         encode_debug_figures(out_dir, out_dir/(video_path.with_suffix(".gif").name))
 
@@ -2,7 +2,6 @@ from pathlib import Path
 import argparse
 
 from typing import Optional
-from moviepy.editor import ImageSequenceClip
 import logging
 from shared import add_shared_parser_options, VIDEO_EXT
 
@@ -16,6 +15,7 @@ def encode_debug_figures(input_dir: Path, output_path: Optional[Path] = None, fp
     assert not output_path.exists(), f"video file already found {output_path}"
     output_path.parent.mkdir(parents=True, exist_ok=True)
     # Create a clip from the images
+    from moviepy.video.io.ImageSequenceClip import ImageSequenceClip # lighter than moviepy.editor
     clip = ImageSequenceClip([str(img) for img in still_frames], fps=fps)
 
     